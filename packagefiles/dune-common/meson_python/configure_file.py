@@ -4,8 +4,22 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import json
+import os
+import re
 from argparse import ArgumentParser
 from pathlib import Path
+from typing import Final
+
+# “#cmakedefine” lines as well as “${KEY}” and “@KEY@” references, which are
+# all matched in a single pass over the file
+_template_re: Final = re.compile(
+    r"^(?P<define>#cmakedefine[^ \n]* (?P<key>[^ \n]*)(?: (?P<value>[^\n]*))?)$"
+    r"|\$\{(?P<brace>[^}\n]*)\}"
+    r"|@(?P<at>[^@\n]*)@",
+    re.MULTILINE,
+)
+_reference_re: Final = re.compile(r"\$\{([^}\n]*)\}|@([^@\n]*)@")
 
 
 def split_config(config_str: str) -> dict[str, str]:
@@ -49,92 +63,152 @@ def compute_private(contents: str) -> str:
     pairs += [(i, i + len(prefix)) for i in pres]
     pairs.sort()
 
-    out = ""
+    out: list[str] = []
     start = 0
     for ipre, isuf in pairs:
-        out += f"{contents[start:ipre]}\n"
+        out += [contents[start:ipre], "\n"]
         start = isuf
-    return out + contents[start:]
+    out.append(contents[start:])
+    return "".join(out)
+
+
+class Template:
+    """
+    A file to configure, which is split into literal text and substitutions once
+    so that rendering it only takes time linear in the size of the output.
+    """
+
+    def __init__(self, text: str):
+        # Literal text, references “(key,)”, and “#cmakedefine” lines
+        # “(key, value)”
+        self.parts: list[str | tuple[str] | tuple[str, str | None]] = []
+        start = 0
+        for m in _template_re.finditer(text):
+            self.parts.append(text[start : m.start()])
+            start = m.end()
+            match m.lastgroup:
+                case "define":
+                    self.parts.append((m.group("key"), m.group("value")))
+                case group:
+                    self.parts.append((m.group(group),))
+        self.parts.append(text[start:])
+
+    @staticmethod
+    def _define(config: dict[str, str], key: str, value: str | None) -> str:
+        config_value = config.get(key, None)
+        if config_value is None or config_value == "0":
+            return f"/* #undef {key} */"
+        if value is None:
+            return f"#define {key}"
+        # References in the value of the definition are substituted as well
+        value = _reference_re.sub(
+            lambda m: config[m.group(1) if m.group(1) is not None else m.group(2)],
+            value,
+        )
+        return f"#define {key} {value}"
+
+    def render(self, config: dict[str, str]) -> str:
+        out: list[str] = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+            elif len(part) == 1:
+                out.append(config[part[0]])
+            else:
+                out.append(self._define(config, *part))
+        return "".join(out)
+
+
+def write_if_changed(path: Path, contents: str):
+    """
+    Atomically replace the file if its contents differ, which keeps the modification
+    time of unchanged files and thereby avoids recompiling everything including them.
+    """
+    if path.exists() and path.read_text() == contents:
+        return
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(contents)
+    os.replace(tmp_path, path)
+
+
+def escape_dep(path: Path) -> str:
+    return str(path).replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+
+def configure(
+    in_paths: list[Path],
+    out_path: Path,
+    config: dict[str, str],
+    depfile: Path | None = None,
+):
+    """Configure the last input file, prefixed by the public parts of the others."""
+    out: list[str] = []
+    for p in in_paths[:-1]:
+        with open(p, "r") as in_file:
+            out += [compute_private(in_file.read()), "\n"]
+    with open(in_paths[-1], "r") as in_file:
+        out.append(Template(in_file.read()).render(config))
+    write_if_changed(out_path, "".join(out))
+
+    # A Ninja-compatible list of all files that the output depends on, whose target
+    # is the file name which Meson’s “configure_file” looks the dependencies up by
+    if depfile is not None:
+        deps = " ".join(escape_dep(p) for p in in_paths)
+        write_if_changed(depfile, f"{escape_dep(Path(out_path.name))}: {deps}\n")
 
 
 class Ns:
     def __init__(self):
-        self.in_paths: list[Path]
-        self.out_path: Path
-        self.config: str
+        self.in_paths: list[str]
+        self.batch: Path | None
+        self.depfile: Path | None
 
 
 parser = ArgumentParser(description="Configure a file")
 parser.add_argument(
     "in_paths",
-    nargs="+",
-    type=Path,
-    help="The path of the file to configure",
+    nargs="*",
+    help="The paths of the files to join and configure, "
+    + "followed by the output path and the configuration parameters",
 )
 parser.add_argument(
-    "out_path",
+    "--batch",
     type=Path,
-    help="The path of the file to configure",
+    help="A JSON file containing a list of objects with the keys "
+    + "“inputs” (a list of paths), “output” (a path), and “config” "
+    + "(an object or a string of “key=value” lines), and optionally “depfile”, "
+    + "all of which are configured",
 )
 parser.add_argument(
-    "config",
-    type=str,
-    help="The parameters to configure the file with",
+    "--depfile",
+    type=Path,
+    help="Write a dependency file listing the input files to this path",
 )
 args = parser.parse_args(namespace=Ns())
-join_paths = [p.resolve() for p in args.in_paths[:-1]]
-in_path = args.in_paths[-1].resolve()
-out_path = args.out_path.resolve()
-config = split_config(args.config)
 
-with open(out_path, "w") as out_file:
-    for p in join_paths:
-        with open(p, "r") as in_file:
-            out_file.write(compute_private(in_file.read()) + "\n")
-
-    with open(in_path, "r") as in_file:
-        for line in in_file.readlines():
-            prefix = "#cmakedefine"
-            if line.startswith(prefix):
-                key_start = line.index(" ") + 1
-                key_end = index(" ", line, key_start)
-                if key_end is None:
-                    key_end = len(line) - 1
-                    value_start = None
-                else:
-                    value_start = key_end + 1
-
-                key = line[key_start:key_end]
-                value = config.get(key, None)
-                if value is None or value == "0":
-                    line = f"/* #undef {key} */"
-                else:
-                    parts = ["#define", key]
-                    if value_start is not None:
-                        parts.append(line[value_start:-1])
-                    line = " ".join(parts)
-
-            i = 0
-            while i < len(line):
-                c = line[i]
-
-                if c == "$":
-                    assert line[i + 1] == "{"
-                    start_index = i + 2
-                    end_index = line.index("}", start_index)
-                    value = config[line[start_index:end_index]]
-                    line = line[:i] + value + line[end_index + 1 :]
-                    i += len(value)
-                    continue
-
-                if c == "@":
-                    start_index = i + 1
-                    end_index = line.index("@", start_index)
-                    value = config[line[start_index:end_index]]
-                    line = line[:i] + value + line[end_index + 1 :]
-                    i += len(value)
-                    continue
-
-                i += 1
-
-            out_file.write(line)
+if args.batch is not None:
+    if args.in_paths or args.depfile is not None:
+        parser.error("Only “--batch” is allowed in batch mode")
+    with open(args.batch, "r") as f:
+        jobs = json.load(f)
+    for job in jobs:
+        config = job["config"]
+        configure(
+            [Path(p).resolve() for p in job["inputs"]],
+            Path(job["output"]).resolve(),
+            split_config(config) if isinstance(config, str) else config,
+            Path(job["depfile"]).resolve() if "depfile" in job else None,
+        )
+else:
+    if len(args.in_paths) < 3:
+        parser.error(
+            "At least an input path, an output path, and a config are required"
+        )
+    *in_paths, out_path, config_str = args.in_paths
+    configure(
+        [Path(p).resolve() for p in in_paths],
+        Path(out_path).resolve(),
+        split_config(config_str),
+        None if args.depfile is None else args.depfile.resolve(),
+    )
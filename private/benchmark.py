@@ -0,0 +1,409 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Benchmarks of Tlaxcaltin’s own tooling, which run offline on generated data:
+# - expanding and pruning synthetic catalogues with deep dependency chains,
+# - configuring “#cmakedefine”-heavy headers using “configure_file.py”,
+# - updating a project with a large package cache from a local repository.
+# The results are written as JSON including the phases recorded by the tracer and
+# can be compared to the results of another commit to detect regressions.
+
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from argparse import ArgumentParser
+from collections.abc import Callable
+from contextlib import redirect_stdout
+from hashlib import sha256
+from io import StringIO
+from pathlib import Path
+from random import Random
+from shutil import copytree, rmtree
+from subprocess import DEVNULL, PIPE, run
+from tempfile import TemporaryDirectory
+from typing import Any
+
+base_path = Path(__file__).parents[1]
+sys.path.insert(0, str(base_path / "src"))
+
+from tlaxcaltin.graph import DependencyGraph  # noqa: E402
+from tlaxcaltin.manifest import write_manifest  # noqa: E402
+from tlaxcaltin.trace import tracer  # noqa: E402
+from tlaxcaltin.update import _prune, update  # noqa: E402
+
+configure_file_path = (
+    base_path / "packagefiles" / "dune-common" / "meson_python" / "configure_file.py"
+)
+_git = ["git", "-c", "user.name=Benchmark", "-c", "user.email=benchmark@localhost"]
+
+
+class Ns:
+    def __init__(self):
+        self.sizes: list[int]
+        self.chain_length: int
+        self.update_size: int
+        self.archive_size: int
+        self.headers: int
+        self.defines: int
+        self.repeat: int
+        self.filter: list[str]
+        self.output: Path | None
+        self.compare: Path | None
+        self.tolerance: float
+
+
+parser = ArgumentParser(description="Benchmark Tlaxcaltin’s tooling offline")
+parser.add_argument(
+    "--sizes",
+    type=int,
+    nargs="+",
+    default=[30, 300, 1000, 5000],
+    help="The numbers of wraps in the synthetic catalogues",
+)
+parser.add_argument(
+    "--chain-length",
+    type=int,
+    default=100,
+    help="The length of the dependency chains in the synthetic catalogues",
+)
+parser.add_argument(
+    "--update-size",
+    type=int,
+    default=300,
+    help="The number of wraps in the repository used by the update workload",
+)
+parser.add_argument(
+    "--archive-size",
+    type=int,
+    default=32,
+    help="The size of each archive in the package cache in KiB",
+)
+parser.add_argument(
+    "--headers", type=int, default=20, help="The number of headers to configure"
+)
+parser.add_argument(
+    "--defines",
+    type=int,
+    default=2000,
+    help="The number of “#cmakedefine” lines in each header",
+)
+parser.add_argument(
+    "--repeat",
+    type=int,
+    default=5,
+    help="The number of runs of each benchmark",
+)
+parser.add_argument(
+    "--filter",
+    "-k",
+    nargs="+",
+    default=[],
+    help="Only run the benchmarks whose names contain any of these strings",
+)
+parser.add_argument("--output", "-o", type=Path, help="Write the results as JSON")
+parser.add_argument(
+    "--compare",
+    type=Path,
+    help="Compare the results to those of an earlier run and fail on regressions",
+)
+parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.25,
+    help="The relative slowdown of the fastest run that counts as a regression",
+)
+args = parser.parse_args(namespace=Ns())
+
+results: dict[str, dict[str, Any]] = {}
+
+
+def benchmark(
+    name: str,
+    fn: Callable[[], Any],
+    setup: Callable[[], Any] | None = None,
+):
+    """
+    Run the function repeatedly, calling the (untimed) setup before each run,
+    and record the wall times together with the minimal duration of each phase.
+    """
+    if args.filter and not any(f in name for f in args.filter):
+        return
+    runs: list[float] = []
+    phases: dict[str, float] = {}
+    for _ in range(args.repeat):
+        if setup is not None:
+            setup()
+        tracer.spans.clear()
+        with redirect_stdout(StringIO()):
+            start = time.perf_counter()
+            fn()
+            runs.append(time.perf_counter() - start)
+        durations: dict[str, float] = {}
+        for s in tracer.spans:
+            durations[s.name] = durations.get(s.name, 0.0) + s.duration
+        for phase, duration in durations.items():
+            phases[phase] = min(phases.get(phase, duration), duration)
+    results[name] = {
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "runs": runs,
+        "phases": phases,
+    }
+    print(f"{name:<40} {min(runs) * 1000:10.2f} ms", flush=True)
+
+
+def archive(name: str) -> bytes:
+    """The contents of the synthetic source archive of a wrap."""
+    return sha256(name.encode()).digest() * (args.archive_size * 32)
+
+
+def write_catalogue(path: Path, size: int, rng: Random) -> list[str]:
+    """
+    Write a synthetic catalogue with the given number of wraps, each of which
+    continues a dependency chain and sometimes depends on a random earlier wrap,
+    and return the names of the wraps.
+    """
+    names = [f"sp{i:05}" for i in range(size)]
+    folders = [f"folder{i}" for i in range(max(1, size // 100))]
+    patch_path = path / "packagefiles" / "patch"
+    patch_path.mkdir(parents=True)
+
+    gitignore = [f"/{f}/" for f in ("packagecache", *folders)]
+    for i, name in enumerate(names):
+        deps: list[str] = []
+        if i % args.chain_length != 0:
+            deps.append(names[i - 1])
+        if i > 0 and rng.random() < 0.3:
+            deps.append(names[rng.randrange(i)])
+        if rng.random() < 0.1:
+            deps.append(rng.choice(folders))
+        deps = sorted(set(deps))
+
+        diff_files = ""
+        if i % 10 == 0:
+            diff_files = f"diff_files = patch/{name}.patch\n"
+            (patch_path / f"{name}.patch").write_text(f"--- a/{name}\n+++ b/{name}\n")
+        (path / f"{name}.wrap").write_text(
+            (f"# dependencies: {', '.join(deps)}\n\n" if deps else "")
+            + "[wrap-file]\n"
+            + f"directory = {name}-1.0\n"
+            + f"source_url = https://example.invalid/{name}-1.0.tar.gz\n"
+            + f"source_filename = {name}-1.0.tar.gz\n"
+            + f"source_hash = {sha256(archive(name)).hexdigest()}\n"
+            + f"patch_directory = {name}\n"
+            + diff_files
+            + "\n[provide]\n"
+            + f"dependency_names = {name}\n"
+        )
+        package_path = path / "packagefiles" / name
+        package_path.mkdir()
+        (package_path / "meson.build").write_text(
+            f"project('{name}', 'cpp')\n"
+            + f"{name}_dep = declare_dependency()\n"
+            + f"meson.override_dependency('{name}', {name}_dep)\n"
+        )
+        gitignore.append(f"/{name}-*/")
+    for folder in folders:
+        (path / folder).mkdir()
+        (path / folder / "meson.build").write_text(f"project('{folder}')\n")
+
+    (path / ".gitignore").write_text("".join(f"{line}\n" for line in gitignore))
+    (path / "License").write_text("Mozilla Public License Version 2.0\n")
+    (path / "LicenseWrapDB").write_text("MIT License\n")
+    (path / "ReadMe.md").write_text(
+        "# Tlaxcaltin\n\n## Licence\n\n"
+        + "Tlaxcaltin is licenced under the terms of the Mozilla Public Licence 2.0.\n"
+        + "Some wraps are based on Meson wraps from the Meson Wrap Database.\n"
+        + "These are:\n\n"
+    )
+    return names
+
+
+def bench_catalogues(tmp_path: Path):
+    for size in args.sizes:
+        rng = Random(size)
+        catalogue_path = tmp_path / f"catalogue-{size}"
+        catalogue_path.mkdir()
+        names = write_catalogue(catalogue_path, size, rng)
+        selection = set(rng.sample(names, min(5, size)))
+
+        benchmark(
+            f"expand selection/{size}",
+            lambda: DependencyGraph.from_path(catalogue_path).resolve(
+                selection, strict=False
+            ),
+        )
+
+        prune_path = tmp_path / f"prune-{size}"
+
+        def setup():
+            rmtree(prune_path, ignore_errors=True)
+            copytree(catalogue_path, prune_path)
+
+        benchmark(f"prune/{size}", lambda: _prune(prune_path, selection), setup)
+        rmtree(prune_path, ignore_errors=True)
+
+
+def write_headers(path: Path) -> Path:
+    """Write headers to configure and the batch file configuring them."""
+    rng = Random(0)
+    jobs: list[dict[str, Any]] = []
+    prefix_path = path / "prefix.hh"
+    prefix_path.write_text(
+        "#pragma once\n"
+        + "".join(
+            f"\n/* begin private */\n#define PRIVATE_{i}\n/* end private */\n"
+            + f"#define PUBLIC_{i}\n"
+            for i in range(args.defines // 10)
+        )
+    )
+    for h in range(args.headers):
+        config: dict[str, str] = {}
+        lines = ["#pragma once"]
+        for i in range(args.defines):
+            key = f"HAVE_FEATURE_{h}_{i}"
+            config[key] = rng.choice(("0", "1", f"{i}"))
+            match i % 4:
+                case 0:
+                    lines.append(f"#cmakedefine {key}")
+                case 1:
+                    lines.append(f"#cmakedefine {key} @{key}@")
+                case 2:
+                    lines.append(f"#cmakedefine01 {key}")
+                case _:
+                    lines.append(f"#define VALUE_{i} ${{{key}}}")
+        template_path = path / f"config{h}.hh.in"
+        template_path.write_text("\n".join(lines) + "\n")
+        jobs.append(
+            {
+                "inputs": [str(prefix_path), str(template_path)],
+                "output": str(path / f"config{h}.hh"),
+                "config": config,
+                "depfile": str(path / f"config{h}.hh.d"),
+            }
+        )
+    batch_path = path / "batch.json"
+    with open(batch_path, "w") as f:
+        json.dump(jobs, f)
+    return batch_path
+
+
+def bench_configure(tmp_path: Path):
+    headers_path = tmp_path / "headers"
+    headers_path.mkdir()
+    batch_path = write_headers(headers_path)
+    command = [sys.executable, str(configure_file_path), "--batch", str(batch_path)]
+
+    def setup():
+        for p in headers_path.glob("config*.hh*"):
+            if p.suffix != ".in":
+                p.unlink()
+
+    # Configuring from scratch and reconfiguring without changes
+    benchmark(
+        "configure_file/fresh", lambda: run(command, check=True, stdout=DEVNULL), setup
+    )
+    benchmark(
+        "configure_file/unchanged", lambda: run(command, check=True, stdout=DEVNULL)
+    )
+
+
+def bench_update(tmp_path: Path):
+    rng = Random(1)
+    repo_path = tmp_path / "repo"
+    repo_path.mkdir()
+    names = write_catalogue(repo_path, args.update_size, rng)
+    (repo_path / "pyproject.toml").write_text("[project]\nname = 'tlaxcaltin'\n")
+    write_manifest(repo_path)
+    run([*_git, "init", "--quiet", repo_path], check=True)
+    run([*_git, "-C", repo_path, "add", "-A"], check=True)
+    run([*_git, "-C", repo_path, "commit", "--quiet", "-m", "Initial"], check=True)
+    url = repo_path.as_uri()
+
+    # A project selecting a few subprojects whose package cache contains the
+    # archives of all subprojects
+    template_path = tmp_path / "project-template"
+    package_cache_path = template_path / "subprojects" / "packagecache"
+    package_cache_path.mkdir(parents=True)
+    for name in names:
+        (package_cache_path / f"{name}-1.0.tar.gz").write_bytes(archive(name))
+    selection = rng.sample(names, min(10, len(names)))
+    (template_path / "subprojects.txt").write_text("\n".join(selection) + "\n")
+
+    project_path = tmp_path / "project"
+    cache_path = tmp_path / "cache"
+    os.environ["TLAXCALTIN_CACHE"] = str(cache_path)
+
+    def fresh():
+        for p in (project_path, cache_path):
+            rmtree(p, ignore_errors=True)
+        copytree(template_path, project_path)
+
+    def new_commit():
+        meson_path = repo_path / "packagefiles" / selection[0] / "meson.build"
+        with open(meson_path, "a") as f:
+            f.write("# changed\n")
+        run([*_git, "-C", repo_path, "commit", "--quiet", "-am", "Change"], check=True)
+
+    def update_project():
+        update(project_path, False, url=url)
+
+    benchmark("update/cold", update_project, fresh)
+    benchmark("update/unchanged", update_project)
+    benchmark("update/new commit", update_project, new_commit)
+
+
+def git_commit() -> str | None:
+    res = run(
+        ["git", "-C", base_path, "rev-parse", "HEAD"], stdout=PIPE, stderr=DEVNULL
+    )
+    return res.stdout.decode().strip() if res.returncode == 0 else None
+
+
+parameters = {
+    k: v
+    for k, v in vars(args).items()
+    if k not in ("repeat", "filter", "output", "compare", "tolerance")
+}
+with TemporaryDirectory() as tmp_dir:
+    tmp_path = Path(tmp_dir).resolve()
+    bench_catalogues(tmp_path)
+    bench_configure(tmp_path)
+    bench_update(tmp_path)
+
+output = {
+    "commit": git_commit(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "parameters": parameters,
+    "results": results,
+}
+if args.output is not None:
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+        f.write("\n")
+
+if args.compare is not None:
+    with open(args.compare, "r") as f:
+        baseline = json.load(f)
+    if baseline["parameters"] != parameters:
+        print("The parameters differ from those of the baseline")
+        sys.exit(2)
+    print(f"Comparison to {baseline['commit']}:")
+    regressions: list[str] = []
+    for name, result in results.items():
+        if (base := baseline["results"].get(name)) is None:
+            continue
+        ratio = result["min"] / base["min"]
+        print(f"{name:<40} {(ratio - 1) * 100:+8.1f} %")
+        if ratio > 1 + args.tolerance:
+            regressions.append(name)
+    for name in regressions:
+        print(f"REGRESSION: {name}")
+    sys.exit(1 if regressions else 0)
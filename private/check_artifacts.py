@@ -0,0 +1,121 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Check that a project builds using a cached artifact, i.e. that a small library
+# subproject that is stored in the artifact cache after building it is not compiled
+# again when the project is configured in a fresh build folder using the artifact,
+# and that the executable linked against the prebuilt library runs.
+# This requires Meson, Ninja, and a C compiler.
+
+import os
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from subprocess import PIPE, STDOUT, run
+from tempfile import TemporaryDirectory
+
+base_path = Path(__file__).parents[1]
+
+sources = {
+    "meson.build": """
+project('main', 'c')
+foo_dep = dependency('foo')
+executable('main', 'main.c', dependencies: foo_dep)
+""",
+    "main.c": """
+#include <stdio.h>
+#include <foo/foo.h>
+int main(void) { printf("%g\\n", foo(16.0)); return 0; }
+""",
+    "subprojects/foo.wrap": """
+[wrap-file]
+directory = foo
+
+[provide]
+foo = foo_dep
+""",
+    "subprojects/foo/meson.build": """
+project('foo', 'c', version: '1.0.0')
+m_dep = meson.get_compiler('c').find_library('m', required: false)
+inc = include_directories('include')
+lib = library('foo', 'src/foo.c', include_directories: inc, dependencies: m_dep)
+foo_dep = declare_dependency(include_directories: inc, link_with: lib)
+""",
+    "subprojects/foo/include/foo/foo.h": "double foo(double x);\n",
+    "subprojects/foo/src/foo.c": """
+#include <math.h>
+#include <foo/foo.h>
+double foo(double x) { return sqrt(x); }
+""",
+}
+
+
+class Ns:
+    def __init__(self):
+        self.default_library: list[str]
+
+
+parser = ArgumentParser(description="Check building using a cached artifact.")
+parser.add_argument(
+    "--default-library",
+    nargs="+",
+    default=["static", "shared"],
+    help="The kinds of libraries to check",
+)
+args = parser.parse_args(namespace=Ns())
+
+failures: list[str] = []
+for default_library in args.default_library:
+    with TemporaryDirectory() as tmp_dir:
+        project_path = Path(tmp_dir) / "project"
+        for rel, txt in sources.items():
+            (project_path / rel).parent.mkdir(parents=True, exist_ok=True)
+            (project_path / rel).write_text(txt.lstrip())
+        env = {
+            **os.environ,
+            "PYTHONPATH": str(base_path / "src"),
+            "TLAXCALTIN_ARTIFACTS": str(Path(tmp_dir) / "artifacts"),
+        }
+
+        def step(*cmd: str, tlaxcaltin: bool = False) -> str:
+            if tlaxcaltin:
+                cmd = (
+                    sys.executable,
+                    "-c",
+                    "import tlaxcaltin; tlaxcaltin.run()",
+                    *cmd,
+                )
+            res = run(cmd, cwd=project_path, env=env, stdout=PIPE, stderr=STDOUT)
+            out = res.stdout.decode(errors="replace")
+            if res.returncode != 0:
+                raise RuntimeError(f"“{' '.join(cmd[-4:])}” failed:\n{out}")
+            return out
+
+        count = len(failures)
+        try:
+            setup = ("meson", "setup", f"-Ddefault_library={default_library}")
+            step(*setup, "build")
+            step("meson", "compile", "-C", "build")
+            step("artifacts", "store", "-C", "build", tlaxcaltin=True)
+            step("artifacts", "use", "-C", "build", tlaxcaltin=True)
+
+            # A fresh build folder must only compile the main project
+            step(*setup, "prebuilt")
+            step("meson", "compile", "-C", "prebuilt")
+            commands = step("ninja", "-C", "prebuilt", "-t", "commands")
+            output = step(str(Path("prebuilt") / "main")).strip()
+        except RuntimeError as e:
+            failures.append(f"{default_library}: {e}")
+            continue
+        if "foo.c" in commands:
+            failures.append(f"{default_library}: the artifact is compiled again")
+        if output != "4":
+            failures.append(f"{default_library}: the executable prints {output!r}")
+        print(f"{default_library}: {'ok' if len(failures) == count else 'failed'}")
+
+for failure in failures:
+    print(f"FAILED: {failure}")
+sys.exit(1 if failures else 0)
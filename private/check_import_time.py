@@ -0,0 +1,127 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Check that starting Tlaxcaltin and completing its arguments stays fast, i.e. that
+# building the parser does not import any heavy module and takes less time than the
+# budget according to “python -X importtime”, and that completion is fast as well.
+
+import os
+import re
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from subprocess import PIPE, run
+from tempfile import TemporaryDirectory
+
+base_path = Path(__file__).parents[1]
+# Modules that must only be imported once a subcommand runs
+forbidden = (
+    "argcomplete",
+    "concurrent.futures",
+    "configparser",
+    "dataclasses",
+    "hashlib",
+    "pydantic",
+    "subprocess",
+    "tarfile",
+    "urllib.request",
+)
+_importtime_re = re.compile(r"import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)")
+
+
+class Ns:
+    def __init__(self):
+        self.budget: float
+        self.completion_budget: float
+        self.repeat: int
+
+
+parser = ArgumentParser(description="Check the startup time of Tlaxcaltin")
+parser.add_argument(
+    "--budget",
+    type=float,
+    default=10.0,
+    help="The maximum cumulative import time of “tlaxcaltin” in milliseconds",
+)
+parser.add_argument(
+    "--completion-budget",
+    type=float,
+    default=250.0,
+    help="The maximum wall time of completing a subcommand in milliseconds",
+)
+parser.add_argument(
+    "--repeat",
+    type=int,
+    default=5,
+    help="The number of measurements, of which the fastest is used",
+)
+args = parser.parse_args(namespace=Ns())
+
+env = {**os.environ, "PYTHONPATH": str(base_path / "src")}
+code = "import sys, tlaxcaltin; tlaxcaltin.build_parser(); print(*sys.modules)"
+failures: list[str] = []
+
+import_times: list[float] = []
+for _ in range(args.repeat):
+    res = run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        stdout=PIPE,
+        stderr=PIPE,
+        text=True,
+        check=True,
+    )
+    # The cumulative time of the top-level import of the package in milliseconds
+    import_times += [
+        int(m.group(2)) / 1000
+        for m in map(_importtime_re.match, res.stderr.splitlines())
+        if m is not None and m.group(3) == " " and m.group(4) == "tlaxcaltin"
+    ]
+    modules = set(res.stdout.split())
+    for module in forbidden:
+        if module in modules and f"{module} is imported" not in failures:
+            failures.append(f"{module} is imported")
+import_time = min(import_times)
+print(f"Import time: {import_time:.1f} ms (budget {args.budget:.1f} ms)")
+if import_time > args.budget:
+    failures.append("the import time exceeds the budget")
+
+# Complete “tlaxcaltin up” as the shell integration of argcomplete does
+completion_times: list[float] = []
+with TemporaryDirectory() as tmp_dir:
+    out_path = Path(tmp_dir) / "completions"
+    completion_env = {
+        **env,
+        "_ARGCOMPLETE": "1",
+        "_ARGCOMPLETE_STDOUT_FILENAME": str(out_path),
+        "COMP_LINE": "tlaxcaltin up",
+        "COMP_POINT": "13",
+        "COMP_TYPE": "9",
+    }
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        run(
+            [sys.executable, "-c", "import tlaxcaltin; tlaxcaltin.run()"],
+            env=completion_env,
+            stdout=PIPE,
+            stderr=PIPE,
+        )
+        completion_times.append((time.perf_counter() - start) * 1000)
+    completions = out_path.read_text() if out_path.exists() else ""
+completion_time = min(completion_times)
+print(
+    f"Completion time: {completion_time:.1f} ms "
+    + f"(budget {args.completion_budget:.1f} ms)"
+)
+if "update" not in completions:
+    failures.append(f"completing “tlaxcaltin up” yields {completions!r}")
+if completion_time > args.completion_budget:
+    failures.append("the completion time exceeds the budget")
+
+for failure in failures:
+    print(f"FAILED: {failure}")
+sys.exit(1 if failures else 0)
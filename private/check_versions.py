@@ -4,38 +4,61 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import getpass
+import json
+import os
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from contextlib import closing
-import getpass
 from hashlib import sha256
 from pathlib import Path
+from threading import Lock
+from typing import Any
 
 from colorama import Fore
-from github import Auth, Github
 from pydantic import BaseModel
-from requests import get
-from secretstorage import dbus_init, get_default_collection
+from requests import Session
 
 
 class Args(BaseModel):
     user_name: str
     password: str | None = None
     skip_checksums: bool
+    jobs: int
+    cache: Path
+    api_url: str
     names: list[str]
 
 
+default_cache = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "tlaxcaltin"
+    / "check_versions.json"
+)
+
 parser = ArgumentParser(
     description="Check whether the wraps use the most up-to-date version on GitHub."
 )
 parser.add_argument("--user-name", "-u", default="KurtBoehm")
 parser.add_argument("--password", "-p")
 parser.add_argument("--skip-checksums", "-c", action="store_true")
+parser.add_argument("--jobs", "-j", type=int, default=8)
+parser.add_argument(
+    "--cache",
+    type=Path,
+    default=default_cache,
+    help="The file in which GitHub responses and archive hashes are cached",
+)
+parser.add_argument("--api-url", default="https://api.github.com")
 parser.add_argument("names", nargs="*")
 args = Args.model_validate(vars(parser.parse_args()))
 
 password = args.password
 if password is None:
+    from secretstorage import dbus_init, get_default_collection
+
     with closing(dbus_init()) as connection:
         collection = get_default_collection(connection)
         items = [
@@ -49,52 +72,147 @@ if password is None:
         else:
             password = getpass.getpass("Password: ")
 
-gh = Github(auth=Auth.Login(args.user_name, password))
+gh = Session()
+gh.auth = (args.user_name, password)
+gh.headers["Accept"] = "application/vnd.github+json"
 del password
-
-
-tlaxcaltin = Path(__file__).parents[1]
-names = set(args.names) if len(args.names) > 0 else None
-for path in sorted(tlaxcaltin.iterdir()):
-    if path.suffix != ".wrap":
-        continue
-    if names is not None and path.stem not in names:
-        continue
-
+# Archives are downloaded without credentials
+downloads = Session()
+
+
+class Cache:
+    """
+    Cached GitHub responses (with their ETags) and archive hashes, keyed by URL.
+    Archive URLs refer to fixed releases, so their hashes never need to be updated.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = Lock()
+        self.data: dict[str, dict[str, Any]] = {"api": {}, "archives": {}}
+        if path.exists():
+            with open(path, "r") as f:
+                self.data |= json.load(f)
+
+    def get(self, kind: str, url: str) -> Any:
+        with self.lock:
+            return self.data[kind].get(url)
+
+    def set(self, kind: str, url: str, value: Any):
+        with self.lock:
+            self.data[kind][url] = value
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f)
+        tmp_path.replace(self.path)
+
+
+cache = Cache(args.cache)
+rate_limit_lock = Lock()
+
+
+def github_get(url: str) -> Any:
+    """
+    Perform a conditional GET request, which does not count against the rate limit
+    if the cached response is still valid, and wait if the rate limit is exhausted.
+    """
+    cached = cache.get("api", url)
+    headers = {"If-None-Match": cached["etag"]} if cached else {}
+    while True:
+        # Requests are blocked while another thread waits for the rate limit reset
+        with rate_limit_lock:
+            pass
+        response = gh.get(url, headers=headers)
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if response.status_code in (403, 429) and remaining == "0":
+            with rate_limit_lock:
+                reset = int(response.headers.get("X-RateLimit-Reset", "0"))
+                delay = max(reset - time.time(), 0) + 1
+                print(f"{Fore.YELLOW}Rate limit exceeded, waiting {delay:.0f}s")
+                time.sleep(delay)
+            continue
+        break
+
+    if response.status_code == 304:
+        return cached["body"]
+    response.raise_for_status()
+    body = response.json()
+    if etag := response.headers.get("ETag"):
+        cache.set("api", url, {"etag": etag, "body": body})
+    return body
+
+
+def archive_hash(url: str) -> str:
+    if (h := cache.get("archives", url)) is not None:
+        return h
+    hasher = sha256()
+    with downloads.get(url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(1 << 20):
+            hasher.update(chunk)
+    h = hasher.hexdigest()
+    cache.set("archives", url, h)
+    return h
+
+
+def check(path: Path) -> list[str]:
     parser = ConfigParser()
     with open(path, "r") as f:
         parser.read_file(f)
     if "wrap-file" not in parser:
-        continue
+        return []
 
     url = parser["wrap-file"]["source_url"]
     wrap_hash = parser["wrap-file"]["source_hash"]
+    lines: list[str] = []
 
     def verify_hash():
         if not args.skip_checksums:
-            hash = sha256(get(url).content).hexdigest()
+            hash = archive_hash(url)
             color = Fore.GREEN if wrap_hash == hash else Fore.RED
-            print(f"{color}{wrap_hash} → {hash}{Fore.RESET}")
+            lines.append(f"{color}{wrap_hash} → {hash}{Fore.RESET}")
 
     prefix = "https://github.com/"
     if not url.startswith(prefix):
-        print(url)
+        lines.append(url)
         verify_hash()
-        continue
+        return lines
     if "/archive" not in url:
-        print(url)
-        continue
+        lines.append(url)
+        return lines
     user, repo = url[len(prefix) : url.index("/archive")].split("/")
     release = url[url.rfind("/") + 1 : -len(".tar.gz")]
+    html_url = f"https://github.com/{user}/{repo}"
 
-    repo = gh.get_repo(f"{user}/{repo}")
     try:
-        tarball = repo.get_latest_release().tarball_url
-        tarver = tarball[tarball.rfind("/") + 1 :]
+        latest = github_get(f"{args.api_url}/repos/{user}/{repo}/releases/latest")
+        tarver = latest["tag_name"]
 
         color = Fore.GREEN if release == tarver else Fore.RED
-        print(f"{color}{repo.html_url}{Fore.RESET}", release, tarver)
+        lines.append(f"{color}{html_url}{Fore.RESET} {release} {tarver}")
         verify_hash()
     except Exception as ex:
-        print(f"{Fore.MAGENTA}{repo.html_url}{Fore.RESET}", release, ex)
+        lines.append(f"{Fore.MAGENTA}{html_url}{Fore.RESET} {release} {ex}")
         verify_hash()
+    return lines
+
+
+tlaxcaltin = Path(__file__).parents[1]
+names = set(args.names) if len(args.names) > 0 else None
+paths = [
+    path
+    for path in sorted(tlaxcaltin.iterdir())
+    if path.suffix == ".wrap" and (names is None or path.stem in names)
+]
+
+try:
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # The results are printed in order while the checks run concurrently
+        for lines in executor.map(check, paths):
+            for line in lines:
+                print(line)
+finally:
+    cache.save()
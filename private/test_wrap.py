@@ -4,19 +4,44 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import subprocess
+import json
+import sys
+import time
 from argparse import ArgumentParser
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
 from configparser import ConfigParser
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from hashlib import sha256
 from pathlib import Path
-from shutil import copy, copytree, rmtree, unpack_archive
-from subprocess import run
+from shutil import copytree, rmtree, unpack_archive
+from subprocess import STDOUT, run
+from tempfile import TemporaryDirectory
+from typing import Literal, TextIO
 
 from pydantic import BaseModel, Field, TypeAdapter
-from requests import get
+
+base_path = Path(__file__).parents[1]
+sys.path.insert(0, str(base_path / "src"))
+
+from tlaxcaltin.fetch import download  # noqa: E402
+from tlaxcaltin.graph import DependencyGraph  # noqa: E402
+from tlaxcaltin.store import link_file  # noqa: E402
+from tlaxcaltin.trace import report, span  # noqa: E402
+from tlaxcaltin.wraps import read_wrap, read_wraps, wrap_digest  # noqa: E402
 
 
 class Args(BaseModel):
-    wrap: str
+    wraps: list[str]
+    all: bool
+    deps: bool
+    jobs: int
+    no_cache: bool
+    overlay: Literal["symlink", "hardlink"] | None
+    setup: bool
+    compile: bool
+    report: Path | None
 
 
 class WrapSection(BaseModel):
@@ -50,94 +75,467 @@ class GitWrap(BaseModel):
 Wrap = FileWrap | GitWrap
 
 
-parser = ArgumentParser(
-    description="Test a wrap by downloading the source files, "
-    + "unpacking them in the packagecache subfolder, "
-    + "applying the patch directory, "
-    + "applying the diff files, "
-    + "and copying Tlaxcaltin into the subproject’s packagefiles."
-)
-parser.add_argument("wrap")
-args = Args.model_validate(vars(parser.parse_args()))
-
-base_path = Path(__file__).parents[1]
-wrap_path = base_path / f"{args.wrap}.wrap"
-with open(wrap_path, "r") as f:
-    d = ConfigParser()
-    d.read_file(f)
-    d = {s: dict(d.items(s)) for s in d.sections()}
+@dataclass
+class Result:
+    wrap: str
+    passed: bool = False
+    error: str | None = None
+    # The wall time of each phase in seconds
+    phases: dict[str, float] = field(default_factory=dict)
+    total: float = 0.0
 
-wrap = TypeAdapter(Wrap).validate_python(d)
-assert isinstance(wrap, Wrap)
-body = wrap.wrap_body
-directory = body.directory if body.directory else wrap_path.stem
 
 pkg_base_folder = base_path / "packagecache"
-pkg_base_folder.mkdir(exist_ok=True)
-pkg_folder = pkg_base_folder / directory
-print(pkg_folder)
-
-match body:
-    case WrapFileSection():
-        cmp_path = pkg_base_folder / body.source_filename
-        if not cmp_path.exists():
-            data = get(body.source_url).content
-            with open(cmp_path, "wb") as f:
-                f.write(data)
-
-        unpack_archive(cmp_path, pkg_base_folder)
-    case WrapGitSection():
-        if pkg_folder.exists():
-            rmtree(pkg_folder)
-        clone_cmd = [
-            "git",
-            "clone",
-            *(["--recurse-submodules"] if body.clone_recursive else []),
-            body.url,
-            pkg_folder,
-        ]
-        run(clone_cmd)
-
-        if body.revision.lower() != "head":
-            run(["git", "checkout", body.revision], cwd=pkg_folder)
-
-# Apply patch directory
-patch_base_path = base_path / "packagefiles" / body.patch_directory
-for p in patch_base_path.iterdir():
-    outp = pkg_folder / p.name
-    print(f"Copy {p} to {outp}")
-    if p.is_dir():
-        copytree(p, outp, dirs_exist_ok=True)
+# Subprojects that are stored as folders
+folder_subprojects = ("blas", "blas_compat", "mpi", "options")
+# Records the files and wrap digests of a linked “subprojects” folder
+overlay_state_name = ".overlay.json"
+
+
+def copy_file(src: str | Path, dst: str | Path):
+    # Replace instead of overwriting, as the destination may be linked to the cache
+    link_file(Path(src), Path(dst), ("copy",))
+
+
+def _remove(path: Path):
+    if path.is_dir() and not path.is_symlink():
+        rmtree(path)
     else:
-        copy(p, outp)
-
-# Apply diff files (patches)
-if body.diff_files and (diff_files_str := body.diff_files.strip()):
-    diff_files = diff_files_str.split(",")
-    for rel_diff in diff_files:
-        diff_path = base_path / "packagefiles" / rel_diff
-        if not diff_path.is_file():
-            raise FileNotFoundError(f"Diff file not found: {diff_path}")
-        # Apply with 'patch -p1' in the extracted source dir
-        subprocess.run(
-            ["patch", "-p1", "-i", str(diff_path)],
-            cwd=pkg_folder,
-            check=True,
+        path.unlink()
+
+
+def materialize(src: Path, dst: Path, keep: Iterable[str] = ()):
+    """
+    Recreate a cached tree using reflinks (or hard links if reflinks are not
+    supported), so that this only takes a fraction of a second even for large trees.
+    Note that files in hard-linked trees must be replaced, not modified in place.
+    The top-level entries in “keep” are preserved.
+    """
+    if dst.exists():
+        keep = set(keep)
+        for p in dst.iterdir():
+            if p.name not in keep:
+                _remove(p)
+    copytree(
+        src,
+        dst,
+        symlinks=True,
+        dirs_exist_ok=True,
+        copy_function=lambda s, d: link_file(
+            Path(s), Path(d), ("reflink", "hardlink", "copy")
+        ),
+    )
+
+
+def _is_linked(src: Path, dst: Path, method: str) -> bool:
+    if method == "symlink":
+        return dst.is_symlink() and dst.readlink() == src.resolve()
+    try:
+        return not dst.is_symlink() and dst.samefile(src)
+    except FileNotFoundError:
+        return False
+
+
+def _files(rel: str) -> Iterator[str]:
+    """The files at or below the given path relative to the base path."""
+    path = base_path / rel
+    if path.is_file():
+        yield rel
+    elif path.is_dir():
+        for f in path.rglob("*"):
+            if f.is_file() and "__pycache__" not in f.parts:
+                yield f.relative_to(base_path).as_posix()
+
+
+class WrapTest:
+    def __init__(
+        self,
+        name: str,
+        work_path: Path,
+        use_cache: bool,
+        overlay: str | None,
+        log: TextIO,
+    ):
+        self.name = name
+        self.use_cache = use_cache
+        self.overlay = overlay
+        self.log = log
+        self.result = Result(name)
+
+        self.wrap_path = base_path / f"{name}.wrap"
+        with open(self.wrap_path, "r") as f:
+            d = ConfigParser()
+            d.read_file(f)
+            d = {s: dict(d.items(s)) for s in d.sections()}
+
+        wrap = TypeAdapter(Wrap).validate_python(d)
+        assert isinstance(wrap, Wrap)
+        self.body = wrap.wrap_body
+        self.directory = self.body.directory if self.body.directory else name
+
+        self.pkg_folder = work_path / self.directory
+        # Extracted and patched source trees are cached in this folder
+        self.tree_cache = pkg_base_folder / "trees" / name
+        self.tree_cache.mkdir(parents=True, exist_ok=True)
+
+    def print(self, msg: str):
+        print(msg, file=self.log, flush=True)
+
+    def run(self, cmd: list[str | Path], cwd: Path | None = None):
+        run(cmd, cwd=cwd, check=True, stdout=self.log, stderr=STDOUT)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            with span(f"{self.name}: {name}"):
+                yield
+        finally:
+            duration = time.perf_counter() - start
+            self.result.phases[name] = self.result.phases.get(name, 0.0) + duration
+
+    def replace_cached(
+        self, prefix: str, key: str | None, create: Callable[[Path], None]
+    ) -> Path:
+        """
+        Remove all cached trees with the prefix and create the tree for the key,
+        which only appears under its final name once it has been created successfully.
+        """
+        for p in self.tree_cache.glob(f"{prefix}-*"):
+            rmtree(p)
+        path = self.tree_cache / f"{prefix}-{key or 'uncached'}"
+        tmp_path = self.tree_cache / f"{prefix}-{key or 'uncached'}.tmp"
+        create(tmp_path)
+        tmp_path.rename(path)
+        return path
+
+    def fetch_sources(self, dst: Path):
+        body = self.body
+        match body:
+            case WrapFileSection():
+                cmp_path = pkg_base_folder / body.source_filename
+                if not cmp_path.exists():
+                    with self.phase("download"):
+                        download(body.source_url, cmp_path, body.source_hash)
+
+                with self.phase("unpack"):
+                    with TemporaryDirectory(dir=self.tree_cache) as tmp_dir:
+                        unpack_archive(cmp_path, tmp_dir)
+                        (Path(tmp_dir) / self.directory).rename(dst)
+            case WrapGitSection():
+                clone_cmd: list[str | Path] = [
+                    "git",
+                    "clone",
+                    *(["--recurse-submodules"] if body.clone_recursive else []),
+                    body.url,
+                    dst,
+                ]
+                with self.phase("download"):
+                    self.run(clone_cmd)
+
+                    if body.revision.lower() != "head":
+                        self.run(["git", "checkout", body.revision], cwd=dst)
+
+    def patch_sources(self, dst: Path):
+        body = self.body
+
+        # Apply patch directory
+        with self.phase("patch copy"):
+            patch_base_path = base_path / "packagefiles" / body.patch_directory
+            for p in patch_base_path.iterdir():
+                outp = dst / p.name
+                self.print(f"Copy {p} to {outp}")
+                if p.is_dir():
+                    copytree(p, outp, dirs_exist_ok=True, copy_function=copy_file)
+                else:
+                    copy_file(p, outp)
+
+        # Apply diff files (patches)
+        if body.diff_files and (diff_files_str := body.diff_files.strip()):
+            with self.phase("diff apply"):
+                diff_files = diff_files_str.split(",")
+                for rel_diff in diff_files:
+                    diff_path = base_path / "packagefiles" / rel_diff
+                    if not diff_path.is_file():
+                        raise FileNotFoundError(f"Diff file not found: {diff_path}")
+                    # Apply with 'patch -p1' in the extracted source dir
+                    self.run(["patch", "-p1", "-i", str(diff_path)], cwd=dst)
+
+    def prepare(self):
+        body = self.body
+
+        # Sources are identified by their hash or by a fixed Git revision, while the
+        # patched sources additionally depend on the patch directory and diff files
+        source_key: str | None = None
+        match body:
+            case WrapFileSection():
+                source_key = body.source_hash
+            case WrapGitSection() if body.revision.lower() != "head":
+                source_key = sha256(
+                    f"{body.url}\0{body.revision}\0{body.clone_recursive}".encode()
+                ).hexdigest()
+        if not self.use_cache:
+            source_key = None
+        prepared_key = None
+        if source_key is not None:
+            prepared_key = wrap_digest(base_path, read_wrap(self.wrap_path))
+
+        prepared_path = self.tree_cache / f"prepared-{prepared_key}"
+        if prepared_key is None or not prepared_path.exists():
+            source_path = self.tree_cache / f"source-{source_key}"
+            if source_key is None or not source_path.exists():
+                source_path = self.replace_cached(
+                    "source", source_key, self.fetch_sources
+                )
+            else:
+                self.print(f"Reuse the sources in {source_path}")
+
+            def prepare(dst: Path):
+                with self.phase("materialize"):
+                    materialize(source_path, dst)
+                self.patch_sources(dst)
+
+            prepared_path = self.replace_cached("prepared", prepared_key, prepare)
+        else:
+            self.print(f"Reuse the patched sources in {prepared_path}")
+        with self.phase("materialize"):
+            # Linked subprojects are updated incrementally instead
+            keep = ["subprojects"] if self.overlay is not None else []
+            materialize(prepared_path, self.pkg_folder, keep)
+
+    def copy_subprojects(self):
+        # Copy wrap files and auxiliary subprojects
+        subproj_path = self.pkg_folder / "subprojects"
+        subproj_path.mkdir(exist_ok=True)
+
+        for p in base_path.iterdir():
+            outp = subproj_path / p.name
+            if p.suffix == ".wrap":
+                copy_file(p, outp)
+            if p.is_dir() and p.name in folder_subprojects:
+                copytree(p, outp, dirs_exist_ok=True, copy_function=copy_file)
+
+        copytree(
+            base_path / "packagefiles",
+            subproj_path / "packagefiles",
+            dirs_exist_ok=True,
+            copy_function=copy_file,
         )
 
-# Copy wrap files and auxiliary subprojects
-subproj_path = pkg_folder / "subprojects"
-subproj_path.mkdir(exist_ok=True)
-
-for p in base_path.iterdir():
-    outp = subproj_path / p.name
-    if p.suffix == ".wrap":
-        copy(p, outp)
-    if p.is_dir() and p.name in ("blas_compat", "mpi", "options"):
-        copytree(p, outp, dirs_exist_ok=True)
-
-copytree(
-    base_path / "packagefiles",
-    subproj_path / "packagefiles",
-    dirs_exist_ok=True,
-)
+    def link_subprojects(self, method: str):
+        """
+        Link the wraps in the dependency closure of the tested wrap, their patch
+        directories and diff files, and the folder subprojects into “subprojects”.
+        Only links that are missing or outdated are created, and the sources that
+        Meson has extracted are only removed if the corresponding wrap has changed.
+        """
+        subproj_path = self.pkg_folder / "subprojects"
+        subproj_path.mkdir(exist_ok=True)
+        state_path = subproj_path / overlay_state_name
+        old_files: list[str] = []
+        old_digests: dict[str, str] = {}
+        if state_path.exists():
+            with open(state_path, "r") as f:
+                state = json.load(f)
+            old_files, old_digests = state["files"], state["digests"]
+
+        wraps = read_wraps(base_path)
+        graph = DependencyGraph.from_path(base_path)
+        closure = [
+            n for n in graph.resolve([self.name]) if n in wraps and n != self.name
+        ]
+        rel_paths = [p for p in folder_subprojects if (base_path / p).is_dir()]
+        digests: dict[str, str] = {}
+        for dep in closure:
+            wrap = wraps[dep]
+            digests[dep] = wrap_digest(base_path, wrap)
+            rel_paths.append(f"{dep}.wrap")
+            if wrap.patch_directory is not None:
+                rel_paths.append(f"packagefiles/{wrap.patch_directory}")
+            rel_paths += [f"packagefiles/{d}" for d in wrap.diff_files]
+        files = sorted({f for rel in rel_paths for f in _files(rel)})
+
+        # Remove extracted sources of dependencies which have changed or are gone
+        for dep, digest in old_digests.items():
+            if digests.get(dep) != digest and (wrap := wraps.get(dep)) is not None:
+                if (src_path := subproj_path / wrap.directory).exists():
+                    self.print(f"Remove outdated sources {src_path}")
+                    _remove(src_path)
+
+        # Remove files which are no longer part of the overlay
+        for rel in set(old_files) - set(files):
+            (subproj_path / rel).unlink(missing_ok=True)
+
+        linked = 0
+        for rel in files:
+            src, dst = base_path / rel, subproj_path / rel
+            if not _is_linked(src, dst, method):
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                link_file(src, dst, (method, "copy"))
+                linked += 1
+        self.print(f"Linked {linked} of {len(files)} files into {subproj_path}")
+
+        with open(state_path, "w") as f:
+            json.dump({"files": files, "digests": digests}, f, indent=2)
+
+    def build(self, setup: bool, compile: bool):
+        build_path = self.pkg_folder / "build"
+        if setup or compile:
+            with self.phase("meson setup"):
+                self.run(["meson", "setup", build_path], cwd=self.pkg_folder)
+        if compile:
+            with self.phase("compile"):
+                self.run(["meson", "compile", "-C", build_path])
+
+
+def test_wrap(
+    name: str,
+    work_path: Path,
+    use_cache: bool,
+    overlay: str | None,
+    setup: bool,
+    compile: bool,
+    log_path: Path | None,
+) -> Result:
+    start = time.perf_counter()
+    work_path.mkdir(parents=True, exist_ok=True)
+    log = sys.stdout if log_path is None else open(log_path, "w")
+    test = WrapTest(name, work_path, use_cache, overlay, log)
+    try:
+        test.print(str(test.pkg_folder))
+        test.prepare()
+        with test.phase("subproject copy"):
+            if overlay is None:
+                test.copy_subprojects()
+            else:
+                test.link_subprojects(overlay)
+        test.build(setup, compile)
+        test.result.passed = True
+    except Exception as e:
+        test.result.error = f"{type(e).__name__}: {e}"
+        test.print(test.result.error)
+    finally:
+        if log_path is not None:
+            log.close()
+    test.result.total = time.perf_counter() - start
+    return test.result
+
+
+def print_report(results: list[Result]):
+    phases = [
+        "download",
+        "unpack",
+        "materialize",
+        "patch copy",
+        "diff apply",
+        "subproject copy",
+        "meson setup",
+        "compile",
+    ]
+    width = max(len(r.wrap) for r in results)
+    print(" ".join([f"{'wrap':<{width}}", *(f"{p:>15}" for p in phases), "   total"]))
+    for r in results:
+        times = [
+            f"{r.phases[p]:>15.2f}" if p in r.phases else f"{'':>15}" for p in phases
+        ]
+        status = "passed" if r.passed else f"FAILED ({r.error})"
+        print(" ".join([f"{r.wrap:<{width}}", *times, f"{r.total:>8.2f}", status]))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Test wraps by downloading the source files, "
+        + "unpacking them in the packagecache subfolder, "
+        + "applying the patch directory, "
+        + "applying the diff files, "
+        + "and copying Tlaxcaltin into the subproject’s packagefiles."
+    )
+    parser.add_argument("wraps", nargs="*")
+    parser.add_argument("--all", "-a", action="store_true", help="Test all wraps")
+    parser.add_argument(
+        "--deps",
+        "-d",
+        action="store_true",
+        help="Also test the dependencies of the given wraps",
+    )
+    parser.add_argument("--jobs", "-j", type=int, default=1)
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Do not reuse previously extracted and patched source trees",
+    )
+    parser.add_argument(
+        "--overlay",
+        choices=("symlink", "hardlink"),
+        help="Link only the dependencies of each wrap into its subprojects folder "
+        + "and update these links incrementally instead of copying all of Tlaxcaltin",
+    )
+    parser.add_argument("--setup", action="store_true", help="Run “meson setup”")
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Run “meson setup” and “meson compile”",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        help="Write the results including the timings to this JSON file",
+    )
+    args = Args.model_validate(vars(parser.parse_args()))
+
+    names = sorted(p.stem for p in base_path.glob("*.wrap"))
+    if not args.all:
+        if not args.wraps:
+            parser.error("Either wraps or --all need to be given")
+        names = args.wraps
+        if args.deps:
+            graph = DependencyGraph.from_path(base_path)
+            names = [
+                n for n in graph.resolve(names) if (base_path / f"{n}.wrap").exists()
+            ]
+
+    pkg_base_folder.mkdir(exist_ok=True)
+    results: list[Result]
+    if len(names) == 1:
+        # A single wrap is prepared in the package cache itself, as it always has been
+        results = [
+            test_wrap(
+                names[0],
+                pkg_base_folder,
+                not args.no_cache,
+                args.overlay,
+                args.setup,
+                args.compile,
+                None,
+            )
+        ]
+    else:
+        # Each wrap is prepared in its own folder and logs into its own file
+        batch_path = pkg_base_folder / "batch"
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [
+                executor.submit(
+                    test_wrap,
+                    name,
+                    batch_path / name,
+                    not args.no_cache,
+                    args.overlay,
+                    args.setup,
+                    args.compile,
+                    batch_path / f"{name}.log",
+                )
+                for name in names
+            ]
+            results = []
+            for future in futures:
+                results.append(result := future.result())
+                print(f"{result.wrap}: {'passed' if result.passed else 'FAILED'}")
+
+    print_report(results)
+    # Only the phases of wraps tested in this process are traced
+    report(False)
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump([asdict(r) for r in results], f, indent=2)
+    if not all(r.passed for r in results):
+        sys.exit(1)
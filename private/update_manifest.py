@@ -0,0 +1,18 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Regenerate “manifest.json”, which needs to be done whenever a wrap is added,
+# removed, or its dependencies, patch directory, or diff files change.
+
+import sys
+from pathlib import Path
+
+base_path = Path(__file__).parents[1]
+sys.path.insert(0, str(base_path / "src"))
+
+from tlaxcaltin.manifest import write_manifest  # noqa: E402
+
+write_manifest(base_path)
@@ -1,33 +1,401 @@
-from argparse import ArgumentParser
+# PYTHON_ARGCOMPLETE_OK
+
+# The command-line interface, which only defines the arguments of the subcommands
+# and imports the implementation (and the dependencies) of a subcommand once it is
+# run, so that starting Tlaxcaltin and completing its arguments is fast.
+
+import os
+from argparse import ArgumentParser, Namespace
+from collections.abc import Callable
 from pathlib import Path
-from typing import Literal
+from typing import Final, NamedTuple
+
+
+def _configure_update(parser: ArgumentParser):
+    parser.add_argument("--no-add", "-n", action="store_true")
+    parser.add_argument(
+        "--url",
+        help="The Tlaxcaltin repository to use (default: $TLAXCALTIN_URL or GitHub)",
+    )
+    parser.add_argument(
+        "--ref",
+        help="The branch, tag, or commit to use (default: $TLAXCALTIN_REF or HEAD)",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Clone all of Tlaxcaltin instead of only the selected subprojects",
+    )
+    parser.add_argument(
+        "--no-mirror",
+        action="store_true",
+        help="Fetch directly from the repository instead of the local mirror",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Use the local mirror without refreshing it",
+    )
+    parser.add_argument(
+        "--locked",
+        action="store_true",
+        help="Use the URL and commit recorded in subprojects.lock",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print the duration and file counts of each phase as JSON",
+    )
+    parser.add_argument(
+        "--workspace",
+        "-w",
+        type=Path,
+        help="A file listing the paths of projects to update, one per line",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="The number of projects to update in parallel",
+    )
+    parser.add_argument("project_paths", nargs="*", type=Path)
+
+
+def _update(parser: ArgumentParser, args: Namespace):
+    from .update import read_workspace, update, update_many
+
+    project_paths: list[Path] = list(args.project_paths)
+    if args.workspace is not None:
+        project_paths += read_workspace(args.workspace)
+    try:
+        if len(project_paths) <= 1:
+            update(
+                project_paths[0] if project_paths else Path.cwd(),
+                not args.no_add,
+                url=args.url,
+                ref=args.ref,
+                sparse=not args.full,
+                mirror=not args.no_mirror,
+                offline=args.offline,
+                locked=args.locked,
+            )
+        elif args.locked:
+            parser.error("“--locked” is only supported for a single project")
+        else:
+            update_many(
+                project_paths,
+                not args.no_add,
+                url=args.url,
+                ref=args.ref,
+                sparse=not args.full,
+                mirror=not args.no_mirror,
+                offline=args.offline,
+                jobs=args.jobs,
+            )
+    except ValueError as e:
+        parser.error(str(e))
+    except RuntimeError as e:
+        parser.exit(1, f"{e}\n")
+
+
+def _configure_deps(parser: ArgumentParser):
+    parser.add_argument("--project-path", "-p", type=Path)
+    parser.add_argument("names", nargs="*")
+
+
+def _deps(parser: ArgumentParser, args: Namespace):
+    from .deps import deps
+
+    try:
+        deps(args.project_path or Path.cwd(), args.names)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _configure_why(parser: ArgumentParser):
+    parser.add_argument("--project-path", "-p", type=Path)
+    parser.add_argument("name")
+
+
+def _why(parser: ArgumentParser, args: Namespace):
+    from .deps import why
+
+    try:
+        why(args.project_path or Path.cwd(), args.name)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _configure_impact(parser: ArgumentParser):
+    parser.add_argument("--project-path", "-p", type=Path)
+    parser.add_argument(
+        "--diff",
+        metavar="RANGE",
+        help="Consider the files changed in this Git range, e.g. origin/main...HEAD",
+    )
+    parser.add_argument(
+        "--json",
+        dest="json_output",
+        action="store_true",
+        help="Print the changed, affected, and unassigned entries as JSON",
+    )
+    parser.add_argument(
+        "changes",
+        nargs="*",
+        help="Changed subprojects or files relative to the folder containing the wraps",
+    )
+
+
+def _impact(parser: ArgumentParser, args: Namespace):
+    from .deps import impact
+
+    try:
+        impact(
+            args.project_path or Path.cwd(),
+            args.changes,
+            diff_range=args.diff,
+            as_json=args.json_output,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _configure_fetch(parser: ArgumentParser):
+    parser.add_argument("--project-path", "-p", type=Path)
+    parser.add_argument("--jobs", "-j", type=int, default=8)
+    parser.add_argument("names", nargs="*")
+
+
+def _fetch(parser: ArgumentParser, args: Namespace):
+    from .fetch import fetch
+
+    try:
+        fetch(args.project_path or Path.cwd(), args.names, args.jobs)
+    except RuntimeError as e:
+        parser.exit(1, f"{e}\n")
+
+
+def _configure_verify(parser: ArgumentParser):
+    parser.add_argument("--project-path", "-p", type=Path)
+    parser.add_argument("--jobs", "-j", type=int, default=8)
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="Also verify the archives in the shared store",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Remove archives that no wrap refers to and incomplete downloads",
+    )
+
+
+def _verify(parser: ArgumentParser, args: Namespace):
+    from .verify import verify
+
+    try:
+        verify(args.project_path or Path.cwd(), args.jobs, args.store, args.prune)
+    except RuntimeError as e:
+        parser.exit(1, f"{e}\n")
+
+
+def _configure_bundle(parser: ArgumentParser):
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("--project-path", "-p", type=Path)
+    export_parser.add_argument(
+        "--output",
+        "-o",
+        type=Path,
+        default=Path("subprojects.tar.gz"),
+        help="The archive to write, whose suffix determines the compression",
+    )
+    export_parser.add_argument("names", nargs="*")
+    import_parser = subparsers.add_parser("import")
+    import_parser.add_argument("--project-path", "-p", type=Path)
+    import_parser.add_argument("bundle", type=Path)
+
+
+def _bundle(parser: ArgumentParser, args: Namespace):
+    from .bundle import export_bundle, import_bundle
+
+    try:
+        if args.action == "export":
+            export_bundle(args.project_path or Path.cwd(), args.names, args.output)
+        else:
+            import_bundle(args.project_path or Path.cwd(), args.bundle)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _configure_artifacts(parser: ArgumentParser):
+    subparsers = parser.add_subparsers(dest="action", required=True)
+    for action, help in (
+        ("store", "Add the subprojects built in a build folder to the cache"),
+        ("use", "Replace the subprojects with cached artifacts by prebuilt ones"),
+    ):
+        action_parser = subparsers.add_parser(action, help=help)
+        action_parser.add_argument("--project-path", "-p", type=Path)
+        action_parser.add_argument(
+            "-C",
+            dest="build_path",
+            type=Path,
+            required=True,
+            help="The Meson build folder",
+        )
+        action_parser.add_argument("names", nargs="*")
+    subparsers.add_parser("list", help="Show the cached artifacts")
+
+
+def _artifacts(parser: ArgumentParser, args: Namespace):
+    from .artifacts import show_artifacts, store_artifacts, use_artifacts
+
+    if args.action == "list":
+        show_artifacts()
+        return
+    action = store_artifacts if args.action == "store" else use_artifacts
+    try:
+        action(args.project_path or Path.cwd(), args.build_path, args.names)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _configure_profile(parser: ArgumentParser):
+    parser.add_argument(
+        "-C",
+        dest="build_path",
+        type=Path,
+        required=True,
+        help="The Meson build folder",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="The number of targets and critical-path commands to show",
+    )
+    parser.add_argument(
+        "--json",
+        dest="json_output",
+        action="store_true",
+        help="Print the full report as JSON",
+    )
+
+
+def _profile(parser: ArgumentParser, args: Namespace):
+    from .profile import profile
+
+    try:
+        profile(args.build_path, args.top, args.json_output)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _configure_cache(parser: ArgumentParser):
+    parser.add_argument(
+        "--prune",
+        metavar="SIZE",
+        help="Remove the least recently used archives until the store fits, e.g. 20G; "
+        "projects linking to removed archives get them again via “fetch”",
+    )
+
+
+def _cache(parser: ArgumentParser, args: Namespace):
+    from .store import show_cache
+
+    try:
+        show_cache(args.prune)
+    except ValueError as e:
+        parser.error(str(e))
 
-from argcomplete import autocomplete
-from pydantic import BaseModel
 
-from .update import update
+class Command(NamedTuple):
+    name: str
+    help: str | None
+    # Adds the arguments of the command to its parser
+    configure: Callable[[ArgumentParser], None]
+    # Imports the implementation of the command and runs it
+    run: Callable[[ArgumentParser, Namespace], None]
 
 
-class UpdateArgs(BaseModel):
-    mode: Literal["update"]
-    no_add: bool
-    project_path: Path | None
+commands: Final = (
+    Command("update", None, _configure_update, _update),
+    Command(
+        "deps",
+        "Print the dependency closure of subprojects in build order",
+        _configure_deps,
+        _deps,
+    ),
+    Command(
+        "why",
+        "Print why the selected subprojects depend on a subproject",
+        _configure_why,
+        _why,
+    ),
+    Command(
+        "impact",
+        "Print the subprojects affected by changes in build order",
+        _configure_impact,
+        _impact,
+    ),
+    Command(
+        "fetch",
+        "Download the source archives of the subprojects into the package cache",
+        _configure_fetch,
+        _fetch,
+    ),
+    Command(
+        "verify",
+        "Check the source archives in the package cache against their hashes",
+        _configure_verify,
+        _verify,
+    ),
+    Command(
+        "bundle",
+        "Export or import the subprojects and their archives for offline use",
+        _configure_bundle,
+        _bundle,
+    ),
+    Command(
+        "artifacts",
+        "Store or use prebuilt subprojects in the artifact cache",
+        _configure_artifacts,
+        _artifacts,
+    ),
+    Command(
+        "profile",
+        "Report the build time of each subproject and target of a build folder",
+        _configure_profile,
+        _profile,
+    ),
+    Command("cache", "Show the archives in the shared store", _configure_cache, _cache),
+)
 
 
-Args = UpdateArgs
+def build_parser() -> ArgumentParser:
+    parser = ArgumentParser(prog="tlaxcaltin")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    for command in commands:
+        command_parser = subparsers.add_parser(command.name, help=command.help)
+        command.configure(command_parser)
+        command_parser.set_defaults(command=command)
+    return parser
 
 
 def run():
-    parser = ArgumentParser()
-    subparsers = parser.add_subparsers(dest="mode")
+    parser = build_parser()
+    # Completion only requires the parser, so it exits before anything else is loaded
+    if "_ARGCOMPLETE" in os.environ:
+        from argcomplete import autocomplete
 
-    update_parser = subparsers.add_parser("update")
-    update_parser.add_argument("--no-add", "-n", action="store_true")
-    update_parser.add_argument("project_path", nargs="?")
+        autocomplete(parser)
+    args = parser.parse_args()
 
-    autocomplete(parser)
-    args = Args.model_validate(vars(parser.parse_args()))
+    from .trace import report, span
 
-    match args:
-        case UpdateArgs():
-            update(args.project_path or Path.cwd(), not args.no_add)
+    # Report the spans of failed commands as well, which are the most interesting
+    try:
+        with span(args.mode):
+            args.command.run(parser, args)
+    finally:
+        report(getattr(args, "timings", False))
@@ -0,0 +1,445 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# A cache of the libraries and headers that subprojects have been built into,
+# which is keyed by everything that affects the build of a subproject: its sources,
+# its packagefiles and patches, the Meson options, the compilers, and the keys of
+# its dependencies. On a hit, the extracted sources of the subproject are replaced
+# by a generated subproject that only declares the dependencies on the prebuilt
+# libraries, so that Meson does not compile them again. Since Meson does not record
+# the compile arguments of dependencies declared by subprojects, only the include
+# folders of the libraries are passed on to the projects using them.
+#
+# The information about a build is taken from the introspection files that Meson
+# writes into “meson-info” in the build folder, i.e. the usual workflow is
+#   meson setup build && tlaxcaltin artifacts use -C build
+#   meson setup --reconfigure build && meson compile -C build
+#   tlaxcaltin artifacts store -C build
+
+import json
+import os
+from configparser import ConfigParser
+from hashlib import sha256
+from pathlib import Path
+from shutil import copy2, rmtree
+from subprocess import PIPE, run
+from typing import Any, Final
+
+from .graph import DependencyGraph
+from .mirror import cache_path
+from .store import link_file
+from .wraps import Wrap, read_wraps, wrap_digest
+
+_meta_name: Final = "artifact.json"
+# The file marking generated subprojects, which contains the key of the artifact
+_marker_name: Final = ".tlaxcaltin-prebuilt"
+_option_files: Final = ("meson_options.txt", "meson.options")
+_header_suffixes: Final = {
+    ".h",
+    ".hh",
+    ".hpp",
+    ".hxx",
+    ".h++",
+    ".inc",
+    ".inl",
+    ".ipp",
+    ".tcc",
+    ".mod",
+    ".smod",
+}
+_library_types: Final = {"static library", "shared library"}
+# Options that are not specific to a subproject but affect the build of all of them
+_global_options: Final = {
+    "buildtype",
+    "debug",
+    "optimization",
+    "b_ndebug",
+    "b_lto",
+    "b_pie",
+    "b_sanitize",
+    "default_library",
+    "prefer_static",
+    "c_std",
+    "cpp_std",
+    "fortran_std",
+    "c_args",
+    "cpp_args",
+    "fortran_args",
+    "c_link_args",
+    "cpp_link_args",
+    "fortran_link_args",
+}
+
+Json = dict[str, Any]
+
+
+def read_intro(build_path: Path, name: str) -> Any:
+    path = build_path / "meson-info" / f"intro-{name}.json"
+    if not path.exists():
+        raise ValueError(f"{path} does not exist, configure the build first")
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def read_provides(subprojects_path: Path, name: str) -> dict[str, str | None]:
+    """
+    The dependency names that the wrap provides, mapped to the variable that
+    contains them or None if the subproject overrides them itself.
+    """
+    parser = ConfigParser(interpolation=None)
+    parser.read(subprojects_path / f"{name}.wrap")
+    if not parser.has_section("provide"):
+        return {name: None}
+    provide = parser["provide"]
+    out: dict[str, str | None] = {}
+    for dep in provide.get("dependency_names", "").split(","):
+        if dep.strip():
+            out[dep.strip()] = None
+    for dep, variable in provide.items():
+        if dep not in ("dependency_names", "program_names"):
+            out[dep] = variable
+    return out
+
+
+def compiler_identity(build_path: Path) -> list[str]:
+    compilers: Json = read_intro(build_path, "compilers").get("host", {})
+    return [
+        f"{lang}:{c.get('id')}:{c.get('full_version', c.get('version'))}"
+        + f":{' '.join(c.get('exelist', []))}"
+        for lang, c in sorted(compilers.items())
+    ]
+
+
+def build_options(build_path: Path, name: str) -> dict[str, Any]:
+    """The global options and the options of the given subproject."""
+    out: dict[str, Any] = {}
+    for option in read_intro(build_path, "buildoptions"):
+        option_name: str = option["name"]
+        if option.get("machine", "any") == "build":
+            continue
+        if option_name.startswith(f"{name}:"):
+            out[option_name] = option["value"]
+        elif ":" not in option_name and option_name in _global_options:
+            out[option_name] = option["value"]
+    return dict(sorted(out.items()))
+
+
+class ArtifactCache:
+    def __init__(self, path: Path | None = None):
+        if path is None:
+            env_path = os.environ.get("TLAXCALTIN_ARTIFACTS")
+            path = Path(env_path) if env_path else cache_path() / "artifacts"
+        self.path = path
+
+    def entry_path(self, key: str) -> Path:
+        return self.path / key
+
+    def get(self, key: str) -> Json | None:
+        """The metadata of the artifact if it exists, marking it as recently used."""
+        meta_path = self.entry_path(key) / _meta_name
+        if not meta_path.is_file():
+            return None
+        os.utime(meta_path)
+        with open(meta_path, "r") as f:
+            return json.load(f)
+
+
+class ArtifactKeys:
+    """The keys of the subprojects in a project for the given build folder."""
+
+    def __init__(self, subprojects_path: Path, build_path: Path):
+        self.subprojects_path = subprojects_path
+        self.build_path = build_path
+        self.wraps = read_wraps(subprojects_path)
+        self.graph = DependencyGraph.from_path(subprojects_path)
+        self.compilers = compiler_identity(build_path)
+        self._keys: dict[str, str] = {}
+
+    def key(self, name: str) -> str:
+        if (key := self._keys.get(name)) is not None:
+            return key
+        wrap = self.wraps.get(name)
+        inputs = {
+            "name": name,
+            # Wrap files without a source hash are identified by their revision,
+            # which is part of the wrap digest
+            "source_hash": None if wrap is None else wrap.source_hash,
+            "packagefiles": (
+                None if wrap is None else wrap_digest(self.subprojects_path, wrap)
+            ),
+            "options": build_options(self.build_path, name),
+            "compilers": self.compilers,
+            "dependencies": {
+                d: self.key(d) for d in self.graph.dependencies.get(name, ())
+            },
+        }
+        key = sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+        self._keys[name] = key
+        return key
+
+
+def _include_args(parameters: list[str]) -> list[Path]:
+    prefixes = ("-isystem", "-I", "/I")
+    return [
+        Path(a.removeprefix(next(p for p in prefixes if a.startswith(p))))
+        for a in parameters
+        if a.startswith(prefixes)
+    ]
+
+
+def _copy_library(lib: Path, out_path: Path, archiver: list[str]):
+    """
+    Copy a library, turning thin archives, which Meson creates for static libraries
+    that are not installed and which only refer to the object files, into regular
+    archives using the archiver of the build.
+    """
+    with open(lib, "rb") as f:
+        is_thin = f.read(8) == b"!<thin>\n"
+    if not is_thin:
+        copy2(lib, out_path)
+        return
+    cmd = [*archiver, "t", lib.name]
+    members = run(cmd, cwd=lib.parent, stdout=PIPE, text=True, check=True).stdout
+    cmd = [*archiver, "csrD", str(out_path.resolve()), *members.splitlines()]
+    run(cmd, cwd=lib.parent, check=True)
+
+
+def _link_args(
+    names: list[str], entries: dict[str, Json], provided: set[str]
+) -> tuple[list[str], list[str]]:
+    """
+    The dependencies provided by subprojects and the arguments linking the others,
+    which are only listed by Meson if they have been found using “dependency”,
+    while the remaining ones have been found using “find_library”.
+    """
+    dependencies: list[str] = []
+    link_args: list[str] = []
+    for name in names:
+        if name in provided:
+            dependencies.append(name)
+        elif name in entries:
+            link_args += entries[name].get("link_args", [])
+        else:
+            link_args.append(f"-l{name}")
+    return dependencies, list(dict.fromkeys(link_args))
+
+
+def _store_artifact(
+    cache: ArtifactCache,
+    key: str,
+    name: str,
+    subprojects_path: Path,
+    build_path: Path,
+) -> str:
+    """Collect the libraries and headers of a built subproject into the cache."""
+    targets = [
+        t
+        for t in read_intro(build_path, "targets")
+        if t.get("subproject") == name and t["type"] in _library_types
+    ]
+    if not targets:
+        return "no libraries"
+    libraries = [Path(f) for t in targets for f in t["filename"]]
+    if missing := [p for p in libraries if not p.is_file()]:
+        return f"not built ({missing[0].name})"
+
+    # Meson does not list the dependencies declared by subprojects, so the include
+    # folders of the libraries themselves are used instead, which are stored
+    # relative to the source or the build folder of the subproject
+    wraps = read_wraps(subprojects_path)
+    src_path = subprojects_path / wraps[name].directory
+    info = read_intro(build_path, "projectinfo")
+    build_src_path = build_path / info.get("subproject_dir", "subprojects")
+    roots = [src_path.resolve(), (build_src_path / src_path.name).resolve()]
+    include_paths: dict[Path, str] = {}
+    dependency_names: list[str] = []
+    for t in targets:
+        for sources in t["target_sources"]:
+            for include in _include_args(sources.get("parameters", [])):
+                include = include.resolve()
+                for i, root in enumerate(roots):
+                    if include.is_relative_to(root) and include.suffix != ".p":
+                        rel = Path("include", str(i), include.relative_to(root))
+                        include_paths.setdefault(include, rel.as_posix())
+        dependency_names += t.get("dependencies", [])
+
+    tmp_path = cache.entry_path(f"{key}.tmp")
+    rmtree(tmp_path, ignore_errors=True)
+    (tmp_path / "lib").mkdir(parents=True)
+    for t in targets:
+        archiver = next(
+            (s["linker"] for s in t["target_sources"] if "linker" in s), ["ar"]
+        )
+        for lib in map(Path, t["filename"]):
+            _copy_library(lib, tmp_path / "lib" / lib.name, archiver)
+    for include, rel in include_paths.items():
+        (tmp_path / rel).mkdir(parents=True, exist_ok=True)
+        for header in include.rglob("*"):
+            out_path = tmp_path / rel / header.relative_to(include)
+            is_header = header.suffix.lower() in _header_suffixes
+            if is_header and header.is_file() and not out_path.exists():
+                out_path.parent.mkdir(parents=True, exist_ok=True)
+                copy2(header, out_path)
+
+    entries = {d["name"]: d for d in read_intro(build_path, "dependencies")}
+    provided = {
+        d for w in wraps if w != name for d in read_provides(subprojects_path, w)
+    }
+    dependencies, link_args = _link_args(
+        list(dict.fromkeys(dependency_names)), entries, provided
+    )
+    subproject_infos = info.get("subprojects", [])
+    version = next(
+        (p.get("version") for p in subproject_infos if p["name"] == name), None
+    )
+    meta = {
+        "name": name,
+        "key": key,
+        "dependencies": [
+            {
+                "name": dep_name,
+                "variable": variable,
+                "version": version,
+                "include_directories": list(include_paths.values()),
+                "libraries": [lib.name for lib in libraries],
+                "dependencies": dependencies,
+                "link_args": link_args,
+            }
+            for dep_name, variable in read_provides(subprojects_path, name).items()
+        ],
+    }
+
+    # Keep the option files so that the options of the subproject remain defined
+    for option_file in _option_files:
+        if (src_path / option_file).is_file():
+            copy2(src_path / option_file, tmp_path / option_file)
+
+    with open(tmp_path / _meta_name, "w") as f:
+        json.dump(meta, f, indent=2)
+    tmp_path.rename(cache.entry_path(key))
+    size = sum(p.stat().st_size for p in cache.entry_path(key).rglob("*"))
+    return f"stored ({size / 2**20:.1f} MiB)"
+
+
+def _meson_list(items: list[str]) -> str:
+    return "[" + ", ".join(f"'{i}'" for i in items) + "]"
+
+
+def generate_subproject(meta: Json) -> str:
+    """
+    The build definition of a subproject using the prebuilt libraries, which are
+    only found at runtime without further setup on systems using ELF, as the run
+    path is not set on others.
+    """
+    lines = [
+        f"# Generated by Tlaxcaltin from the prebuilt artifact {meta['key']}",
+        f"project('{meta['name']}')",
+        "",
+        "_lib = meson.current_source_dir() / 'lib'",
+        "_rpath = []",
+        "if host_machine.system() not in ['cygwin', 'darwin', 'windows']",
+        "  _rpath += ['-Wl,-rpath,' + _lib]",
+        "endif",
+    ]
+    for i, dep in enumerate(meta["dependencies"]):
+        libs = ", ".join(f"_lib / '{lib}'" for lib in dep["libraries"])
+        includes = _meson_list(dep["include_directories"])
+        dependencies = ", ".join(f"dependency('{d}')" for d in dep["dependencies"])
+        lines += [
+            "",
+            f"_dep{i} = declare_dependency(",
+            f"  include_directories: include_directories({includes}),",
+            f"  link_args: [{libs}] + _rpath + {_meson_list(dep['link_args'])},",
+            f"  dependencies: [{dependencies}],",
+            f"  version: '{dep['version'] or 'unknown'}',",
+            ")",
+            f"meson.override_dependency('{dep['name']}', _dep{i})",
+        ]
+        if dep["variable"] is not None:
+            lines.append(f"{dep['variable']} = _dep{i}")
+    return "\n".join(lines) + "\n"
+
+
+def _is_prebuilt(path: Path) -> str | None:
+    marker = path / _marker_name
+    return marker.read_text().strip() if marker.is_file() else None
+
+
+def _selected(wraps: dict[str, Wrap], names: list[str]) -> list[str]:
+    if unknown := sorted(set(names) - wraps.keys()):
+        raise ValueError(f"Unknown subprojects: {', '.join(unknown)}")
+    return names or sorted(wraps)
+
+
+def store_artifacts(project_path: Path, build_path: Path, names: list[str]):
+    """Add the subprojects built in the build folder to the cache."""
+    subprojects_path = project_path / "subprojects"
+    keys = ArtifactKeys(subprojects_path, build_path)
+    cache = ArtifactCache()
+    cache.path.mkdir(parents=True, exist_ok=True)
+    for name in _selected(keys.wraps, names):
+        key = keys.key(name)
+        if _is_prebuilt(subprojects_path / keys.wraps[name].directory) is not None:
+            status = "prebuilt"
+        elif cache.get(key) is not None:
+            status = "cached"
+        else:
+            status = _store_artifact(cache, key, name, subprojects_path, build_path)
+        print(f"{name}: {status}")
+
+
+def use_artifacts(project_path: Path, build_path: Path, names: list[str]):
+    """
+    Replace the sources of all subprojects with cached artifacts by generated
+    subprojects using these and restore the sources of those without.
+    """
+    subprojects_path = project_path / "subprojects"
+    keys = ArtifactKeys(subprojects_path, build_path)
+    cache = ArtifactCache()
+    changed = False
+    for name in _selected(keys.wraps, names):
+        key = keys.key(name)
+        src_path = subprojects_path / keys.wraps[name].directory
+        current = _is_prebuilt(src_path)
+        if current == key:
+            continue
+        if (meta := cache.get(key)) is None:
+            if current is not None:
+                # Meson extracts the sources again on the next configuration
+                print(f"{name}: no artifact for {key[:12]}, using the sources")
+                rmtree(src_path)
+                changed = True
+            continue
+
+        if src_path.exists():
+            rmtree(src_path)
+        entry_path = cache.entry_path(key)
+        for p in sorted(entry_path.rglob("*")):
+            out_path = src_path / p.relative_to(entry_path)
+            if p.is_dir():
+                out_path.mkdir(parents=True, exist_ok=True)
+            elif p.name != _meta_name:
+                out_path.parent.mkdir(parents=True, exist_ok=True)
+                link_file(p, out_path, ("hardlink", "reflink", "copy"))
+        (src_path / "meson.build").write_text(generate_subproject(meta))
+        (src_path / _marker_name).write_text(f"{key}\n")
+        print(f"{name}: using the artifact {key[:12]}")
+        changed = True
+    if changed:
+        print(f"Run “meson setup --reconfigure {build_path}” to apply the changes.")
+
+
+def show_artifacts():
+    cache = ArtifactCache()
+    entries = sorted(cache.path.glob(f"*/{_meta_name}")) if cache.path.is_dir() else []
+    total = 0
+    for meta_path in entries:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        size = sum(p.stat().st_size for p in meta_path.parent.rglob("*"))
+        total += size
+        print(f"{meta['name']}  {meta['key'][:12]}  {size / 2**20:.1f} MiB")
+    print(f"{len(entries)} artifacts, {total / 2**30:.2f} GiB in {cache.path}")
@@ -0,0 +1,198 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Self-contained archives of the subprojects of a project including their source
+# archives, which allow setting up projects on machines without network access.
+
+import os
+import tarfile
+from collections.abc import Iterator
+from hashlib import sha256
+from pathlib import Path
+from typing import IO, Final, Literal
+
+from .deps import catalogue_path
+from .graph import DependencyGraph
+from .manifest import root_files
+from .store import Store, file_hash, link_file
+from .update import read_selection
+from .wraps import Wrap, read_wraps
+
+_chunk_size: Final = 1 << 20
+_prefix: Final = "subprojects"
+_StreamMode = Literal["w|", "w|gz", "w|bz2", "w|xz"]
+_stream_modes: Final[dict[str, _StreamMode]] = {
+    ".tar": "w|",
+    ".tar.gz": "w|gz",
+    ".tgz": "w|gz",
+    ".tar.bz2": "w|bz2",
+    ".tar.xz": "w|xz",
+}
+
+
+def _stream_mode(path: Path) -> _StreamMode:
+    for suffix, mode in _stream_modes.items():
+        if path.name.endswith(suffix):
+            return mode
+    raise ValueError(f"Unsupported archive type: {path.name}")
+
+
+def _tree(root: Path, rel: str) -> Iterator[str]:
+    path = root / rel
+    if path.is_file():
+        yield rel
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for f in sorted(filenames):
+            yield Path(dirpath, f).relative_to(root).as_posix()
+
+
+def bundle_files(
+    path: Path, wraps: dict[str, Wrap], selection: set[str]
+) -> Iterator[str]:
+    """
+    The files relative to the given folder that the selection requires, excluding
+    the source archives. Checkouts of Git wraps are included if they exist.
+    """
+    yield from (f for f in root_files if (path / f).is_file())
+    extracted = {w.directory for w in wraps.values()}
+    for name in sorted(selection):
+        if (wrap := wraps.get(name)) is None:
+            # Subprojects that are stored as folders, such as “mpi”
+            if name not in extracted and (path / name / "meson.build").exists():
+                yield from _tree(path, name)
+            continue
+        yield f"{name}.wrap"
+        if wrap.patch_directory is not None:
+            yield from _tree(path, f"packagefiles/{wrap.patch_directory}")
+        yield from (f"packagefiles/{d}" for d in wrap.diff_files)
+        if wrap.kind == "wrap-git":
+            if (path / wrap.directory).is_dir():
+                yield from _tree(path, wrap.directory)
+            else:
+                print(f"{name} has not been cloned and requires network access")
+
+
+def export_bundle(project_path: Path, names: list[str], out_path: Path):
+    """
+    Write the selected subprojects, their dependencies, and their verified source
+    archives into a single archive, which is streamed to keep the memory bounded.
+    """
+    mode = _stream_mode(out_path)
+    path = catalogue_path(project_path)
+    wraps = read_wraps(path)
+    graph = DependencyGraph.from_path(path)
+    selection = set(names) if names else read_selection(project_path)
+    selection = graph.closure(graph.dependencies if selection is None else selection)
+
+    # Take missing archives from the store and verify all of them before writing
+    package_cache_path = path / "packagecache"
+    file_wraps = [
+        w for n, w in wraps.items() if n in selection and w.source_filename is not None
+    ]
+    Store().populate(package_cache_path, file_wraps)
+    archives: list[str] = []
+    for wrap in file_wraps:
+        assert wrap.source_filename is not None
+        archive_path = package_cache_path / wrap.source_filename
+        if not archive_path.is_file():
+            raise ValueError(
+                f"{archive_path} is missing, run “tlaxcaltin fetch” first",
+            )
+        if wrap.source_hash is not None and file_hash(archive_path) != wrap.source_hash:
+            raise ValueError(f"{archive_path} does not match its source_hash")
+        archives.append(f"packagecache/{wrap.source_filename}")
+
+    # The archives come last so that their hashes are known when importing them
+    tmp_path = out_path.with_name(f"{out_path.name}.part")
+    with tarfile.open(str(tmp_path), mode) as tar:
+        for rel in [*bundle_files(path, wraps, selection), *archives]:
+            # Follow links into the store instead of storing the links
+            info = tar.gettarinfo((path / rel).resolve(), arcname=f"{_prefix}/{rel}")
+            with open(path / rel, "rb") as f:
+                tar.addfile(info, f)
+    tmp_path.replace(out_path)
+    size = out_path.stat().st_size
+    print(
+        f"Bundled {len(selection)} subprojects into {out_path} ({size / 2**20:.1f} MiB)"
+    )
+
+
+def _import_archive(
+    store: Store,
+    src: IO[bytes],
+    package_cache_path: Path,
+    filename: str,
+    source_hash: str,
+):
+    """Stream an archive into the store, verify it, and link it into the cache."""
+    entry_path = store.entry_path(source_hash, filename)
+    entry_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = entry_path.with_name(f"{entry_path.name}.part")
+    h = sha256()
+    with open(tmp_path, "wb") as dst:
+        while chunk := src.read(_chunk_size):
+            h.update(chunk)
+            dst.write(chunk)
+    if h.hexdigest() != source_hash:
+        tmp_path.unlink()
+        raise ValueError(f"{filename} in the bundle does not match its source_hash")
+    tmp_path.replace(entry_path)
+    package_cache_path.mkdir(parents=True, exist_ok=True)
+    # A hard link (or a copy) keeps the imported cache usable if the store is pruned
+    link_file(
+        entry_path, package_cache_path / filename, ("hardlink", "reflink", "copy")
+    )
+
+
+def import_bundle(project_path: Path, bundle_path: Path):
+    """
+    Extract a bundle into the project, storing the source archives in the shared
+    store and linking them into the package cache.
+    """
+    subprojects_path = project_path / _prefix
+    package_cache_path = subprojects_path / "packagecache"
+    store = Store()
+    hashes: dict[str, str] | None = None
+    count = 0
+
+    with tarfile.open(str(bundle_path), "r|*") as tar:
+        for member in tar:
+            rel = Path(member.name)
+            # Check the path before touching any file instead of relying on the
+            # filter, which only runs when extracting
+            out_path = (project_path / rel.parent).resolve() / rel.name
+            if (
+                rel.parts[:1] != (_prefix,)
+                or ".." in rel.parts
+                or not out_path.is_relative_to(subprojects_path.resolve())
+            ):
+                raise ValueError(f"Unexpected file in bundle: {member.name}")
+            count += 1
+            if rel.parent.relative_to(_prefix).as_posix() == "packagecache":
+                if hashes is None:
+                    hashes = {
+                        w.source_filename: w.source_hash
+                        for w in read_wraps(subprojects_path).values()
+                        if w.source_filename is not None and w.source_hash is not None
+                    }
+                if (source_hash := hashes.get(rel.name)) is not None:
+                    src = tar.extractfile(member)
+                    assert src is not None
+                    _import_archive(
+                        store, src, package_cache_path, rel.name, source_hash
+                    )
+                    continue
+            if member.isfile():
+                # Replace files instead of writing through existing links
+                out_path.unlink(missing_ok=True)
+            try:
+                tar.extract(member, project_path, filter="data")
+            except tarfile.FilterError as e:
+                raise ValueError(f"Unexpected file in bundle: {e}") from e
+
+    print(f"Imported {count} files into {subprojects_path}")
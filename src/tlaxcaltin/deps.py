@@ -0,0 +1,146 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Query the dependency graph of the wraps in a project or in Tlaxcaltin itself.
+
+import json
+from collections.abc import Iterable
+from pathlib import Path
+from subprocess import PIPE, run
+
+from .graph import DependencyGraph
+from .manifest import load_graph
+from .update import read_selection
+from .wraps import read_wraps
+
+
+def catalogue_path(project_path: Path) -> Path:
+    """
+    The folder containing the wraps, which is either “subprojects” or the folder
+    itself.
+    """
+    subprojects_path = project_path / "subprojects"
+    if any(subprojects_path.glob("*.wrap")):
+        return subprojects_path
+    return project_path
+
+
+def _load(project_path: Path) -> DependencyGraph:
+    return load_graph(catalogue_path(project_path))
+
+
+def deps(project_path: Path, names: list[str]):
+    """
+    Print the dependency closure of the given names (or the selection) in build
+    order.
+    """
+    graph = _load(project_path)
+    selection = set(names) if names else read_selection(project_path)
+    if selection is None:
+        selection = set(graph.dependencies)
+    for name in graph.resolve(selection):
+        print(name)
+
+
+def why(project_path: Path, name: str):
+    """
+    Print the dependency chains through which the selection requires the given
+    name.
+    """
+    graph = _load(project_path)
+    chains = graph.why(name, read_selection(project_path))
+    if not chains:
+        print(f"Nothing depends on {name}.")
+    for chain in chains:
+        print(" → ".join(chain))
+
+
+def diff_paths(path: Path, diff_range: str) -> list[str]:
+    """The files changed in the given range, relative to the given folder."""
+    res = run(
+        ["git", "diff", "--name-only", "--no-renames", "--relative", diff_range],
+        cwd=path,
+        stdout=PIPE,
+        text=True,
+    )
+    if res.returncode != 0:
+        raise ValueError(f"Could not determine the files changed in {diff_range}")
+    return res.stdout.splitlines()
+
+
+def owners(path: Path, graph: DependencyGraph) -> list[tuple[str, str]]:
+    """
+    Pairs of path prefixes relative to the given folder and the subprojects whose
+    builds change if a file at or below this prefix changes.
+    """
+    out: list[tuple[str, str]] = []
+    wraps = read_wraps(path)
+    for name, wrap in wraps.items():
+        out += [(f"{name}.wrap", name), (f"{wrap.directory}/", name)]
+        if wrap.patch_directory is not None:
+            out.append((f"packagefiles/{wrap.patch_directory}/", name))
+        out += [(f"packagefiles/{d}", name) for d in wrap.diff_files]
+    # Subprojects that are stored as folders, such as “mpi”
+    out += [(f"{name}/", name) for name in graph.dependencies if name not in wraps]
+    return out
+
+
+def changed_subprojects(
+    path: Path, graph: DependencyGraph, changes: Iterable[str]
+) -> tuple[set[str], list[str]]:
+    """
+    Map the changes, which are subproject names or paths relative to the given
+    folder, to subprojects and return these together with the unassigned paths.
+    """
+    prefixes = owners(path, graph)
+    changed: set[str] = set()
+    unassigned: list[str] = []
+    for change in changes:
+        if change in graph.dependencies:
+            changed.add(change)
+            continue
+        change = change.removeprefix("./")
+        if path.name == "subprojects":
+            change = change.removeprefix("subprojects/")
+        names = {
+            name
+            for prefix, name in prefixes
+            if change == prefix or (prefix.endswith("/") and change.startswith(prefix))
+        }
+        if names:
+            changed |= names
+        else:
+            unassigned.append(change)
+    return changed, unassigned
+
+
+def impact(
+    project_path: Path,
+    changes: list[str],
+    diff_range: str | None = None,
+    as_json: bool = False,
+):
+    """
+    Print the subprojects whose builds are affected by the given changes in
+    topological order, i.e. those that changed and all of their dependents.
+    """
+    path = catalogue_path(project_path)
+    graph = load_graph(path)
+    if diff_range is not None:
+        changes = [*changes, *diff_paths(path, diff_range)]
+    changed, unassigned = changed_subprojects(path, graph, changes)
+    affected = graph.affected(changed)
+
+    if as_json:
+        result = {
+            "changed": sorted(changed),
+            "affected": affected,
+            "unassigned": sorted(unassigned),
+        }
+        print(json.dumps(result, indent=2))
+        return
+    for name in affected:
+        print(name)
@@ -0,0 +1,151 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Download the source archives of the selected wraps into the package cache
+# in parallel, so that Meson does not have to download them one at a time.
+
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha256
+from pathlib import Path
+from typing import Final
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from .deps import catalogue_path
+from .graph import DependencyGraph
+from .store import Store, link_file, parse_size
+from .update import read_selection
+from .wraps import Wrap, read_wraps
+
+_chunk_size: Final = 1 << 20
+
+
+def _range_start(content_range: str | None) -> int | None:
+    """The first byte of a “Content-Range: bytes <start>-<end>/<size>” header."""
+    if content_range is None or not content_range.startswith("bytes "):
+        return None
+    start = content_range.removeprefix("bytes ").split("-", 1)[0]
+    return int(start) if start.isdigit() else None
+
+
+def download(url: str, path: Path, source_hash: str | None) -> int:
+    """
+    Stream the file at the given URL to the path while hashing it, resuming from
+    a partial download (“<path>.part”) if possible, and verify the hash before
+    moving it into place. Returns the number of bytes transferred.
+    """
+    part_path = path.with_name(f"{path.name}.part")
+    h = sha256()
+    offset = part_path.stat().st_size if part_path.exists() else 0
+
+    request = Request(url, headers={"User-Agent": "tlaxcaltin"})
+    if offset > 0:
+        request.add_header("Range", f"bytes={offset}-")
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if offset == 0 or e.code != 416:
+            raise
+        # The range is not satisfiable if the partial download is complete already
+        e.close()
+        with open(part_path, "rb") as f:
+            while chunk := f.read(_chunk_size):
+                h.update(chunk)
+        if source_hash is None or h.hexdigest() == source_hash:
+            part_path.replace(path)
+            return 0
+        part_path.unlink()
+        return download(url, path, source_hash)
+
+    transferred = 0
+    with response:
+        if offset > 0 and response.status == 206:
+            # Start over if the server sends a different range than requested
+            if _range_start(response.headers.get("Content-Range")) != offset:
+                part_path.unlink()
+                return download(url, path, source_hash)
+            with open(part_path, "rb") as f:
+                while chunk := f.read(_chunk_size):
+                    h.update(chunk)
+            mode = "ab"
+        else:
+            # Servers that ignore the range request send the whole file
+            mode = "wb"
+        with open(part_path, mode) as f:
+            while chunk := response.read(_chunk_size):
+                h.update(chunk)
+                f.write(chunk)
+                transferred += len(chunk)
+
+    if source_hash is not None and h.hexdigest() != source_hash:
+        part_path.unlink()
+        raise ValueError(f"{path.name}: expected {source_hash}, got {h.hexdigest()}")
+    part_path.replace(path)
+    return transferred
+
+
+def selected_file_wraps(project_path: Path, names: list[str]) -> list[Wrap]:
+    """The file wraps of the given subprojects and their dependencies."""
+    wraps = read_wraps(catalogue_path(project_path))
+    selection = set(names) if names else read_selection(project_path)
+    if selection is not None:
+        graph = DependencyGraph({n: w.dependencies for n, w in wraps.items()})
+        selection = graph.closure(selection, strict=False)
+        wraps = {n: w for n, w in wraps.items() if n in selection}
+    return [w for w in wraps.values() if w.source_filename and w.source_url]
+
+
+def _fetch_wrap(store: Store, package_cache_path: Path, wrap: Wrap) -> int:
+    """Download the archive of the wrap into the store and link it into the cache."""
+    assert wrap.source_url is not None and wrap.source_filename is not None
+    dst = package_cache_path / wrap.source_filename
+    if wrap.source_hash is None:
+        return download(wrap.source_url, dst, None)
+    path = store.entry_path(wrap.source_hash, wrap.source_filename)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    size = download(wrap.source_url, path, wrap.source_hash)
+    link_file(path, dst)
+    return size
+
+
+def fetch(project_path: Path, names: list[str], jobs: int):
+    package_cache_path = project_path / "subprojects" / "packagecache"
+    package_cache_path.mkdir(parents=True, exist_ok=True)
+    store = Store()
+
+    wraps = selected_file_wraps(project_path, names)
+    if (linked := store.populate(package_cache_path, wraps)) > 0:
+        print(f"Linked {linked} archives from {store.path}")
+    missing = [
+        w
+        for w in wraps
+        if w.source_filename is not None
+        and not (package_cache_path / w.source_filename).exists()
+    ]
+    if not missing:
+        print("All source archives are present.")
+        return
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(_fetch_wrap, store, package_cache_path, w): w
+            for w in missing
+        }
+        for future in as_completed(futures):
+            wrap = futures[future]
+            try:
+                size = future.result()
+                print(f"Fetched {wrap.source_filename} ({size / 2**20:.1f} MiB)")
+            except Exception as e:
+                failures += 1
+                print(f"Failed to fetch {wrap.source_filename}: {e}")
+
+    if max_size := os.environ.get("TLAXCALTIN_STORE_MAX_SIZE"):
+        store.prune(parse_size(max_size))
+    if failures > 0:
+        raise RuntimeError(f"{failures} of {len(missing)} downloads failed")
@@ -0,0 +1,142 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# The dependency graph formed by the “# dependencies:” lines of the wraps.
+
+from collections import deque
+from collections.abc import Iterable, Mapping
+from pathlib import Path
+from typing import Any
+
+from .wraps import read_wraps
+
+
+class DependencyGraph:
+    def __init__(self, dependencies: Mapping[str, Iterable[str]]):
+        """
+        “dependencies” maps each known subproject to its direct dependencies,
+        which includes subprojects without dependencies such as “mpi”.
+        """
+        self.dependencies = {k: tuple(v) for k, v in dependencies.items()}
+        self._dependents: dict[str, list[str]] | None = None
+
+    @staticmethod
+    def from_manifest(manifest: dict[str, Any]) -> "DependencyGraph":
+        dependencies = {f: () for f in manifest["folders"]}
+        for name, wrap in manifest["wraps"].items():
+            dependencies[name] = wrap["dependencies"]
+        return DependencyGraph(dependencies)
+
+    @staticmethod
+    def from_path(path: Path) -> "DependencyGraph":
+        dependencies: dict[str, Iterable[str]] = {
+            p.name: () for p in path.iterdir() if (p / "meson.build").exists()
+        }
+        for name, wrap in read_wraps(path).items():
+            dependencies[name] = wrap.dependencies
+        return DependencyGraph(dependencies)
+
+    @property
+    def dependents(self) -> dict[str, list[str]]:
+        if self._dependents is None:
+            self._dependents = {name: [] for name in self.dependencies}
+            for name, deps in self.dependencies.items():
+                for d in deps:
+                    self._dependents.setdefault(d, []).append(name)
+        return self._dependents
+
+    def unknown(self, names: Iterable[str]) -> list[str]:
+        return sorted(n for n in names if n not in self.dependencies)
+
+    def resolve(self, names: Iterable[str], strict: bool = True) -> list[str]:
+        """
+        Compute the transitive closure of the given subprojects in topological order,
+        i.e. each subproject comes after all of its dependencies.
+        Unknown names raise a ValueError if “strict” is set and are kept otherwise.
+        """
+        names = sorted(set(names))
+        order: list[str] = []
+        # Subprojects whose dependencies are currently being visited
+        active: set[str] = set()
+        done: set[str] = set()
+        unknown: set[str] = set()
+
+        for root in names:
+            if root in done:
+                continue
+            # Each entry is a subproject together with the iterator over its
+            # dependencies, which avoids recursion on deep dependency chains
+            stack = [(root, iter(self.dependencies.get(root, ())))]
+            active.add(root)
+            while stack:
+                name, it = stack[-1]
+                dep = next(it, None)
+                if dep is None:
+                    stack.pop()
+                    active.remove(name)
+                    done.add(name)
+                    order.append(name)
+                    if name not in self.dependencies:
+                        unknown.add(name)
+                elif dep in active:
+                    cycle = [n for n, _ in stack]
+                    cycle = cycle[cycle.index(dep) :] + [dep]
+                    raise ValueError(f"Dependency cycle: {' → '.join(cycle)}")
+                elif dep not in done:
+                    active.add(dep)
+                    stack.append((dep, iter(self.dependencies.get(dep, ()))))
+
+        if strict and unknown:
+            raise ValueError(f"Unknown subprojects: {', '.join(sorted(unknown))}")
+        return order
+
+    def closure(self, names: Iterable[str], strict: bool = True) -> set[str]:
+        return set(self.resolve(names, strict))
+
+    def affected(self, names: Iterable[str]) -> list[str]:
+        """
+        Compute all subprojects that depend on any of the given ones, including
+        these themselves, in topological order.
+        """
+        affected = set(names)
+        if unknown := self.unknown(affected):
+            raise ValueError(f"Unknown subprojects: {', '.join(unknown)}")
+        # Breadth-first search along the reverse edges
+        queue = deque(affected)
+        while queue:
+            for d in self.dependents.get(queue.popleft(), ()):
+                if d not in affected:
+                    affected.add(d)
+                    queue.append(d)
+        return [n for n in self.resolve(affected) if n in affected]
+
+    def why(self, name: str, roots: Iterable[str] | None = None) -> list[list[str]]:
+        """
+        Find a shortest dependency chain from each of the roots (or each subproject
+        if no roots are given) that depends on “name” to “name” itself.
+        """
+        if name not in self.dependencies:
+            raise ValueError(f"Unknown subproject: {name}")
+        # Breadth-first search along the reverse edges
+        successor: dict[str, str | None] = {name: None}
+        queue = deque([name])
+        while queue:
+            n = queue.popleft()
+            for d in self.dependents.get(n, ()):
+                if d not in successor:
+                    successor[d] = n
+                    queue.append(d)
+
+        chains: list[list[str]] = []
+        candidates = successor.keys() if roots is None else roots
+        for root in sorted(set(candidates) - {name}):
+            if root not in successor:
+                continue
+            chain = [root]
+            while (n := successor[chain[-1]]) is not None:
+                chain.append(n)
+            chains.append(chain)
+        return chains
@@ -0,0 +1,84 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# “subprojects.lock” records the Tlaxcaltin commit that a project uses, the resolved
+# subprojects, and the hashes of all files vendored into “subprojects”, which allows
+# detecting that an update would not change anything without fetching Tlaxcaltin.
+
+import json
+import os
+import re
+from dataclasses import asdict, dataclass
+from hashlib import sha256
+from pathlib import Path
+from subprocess import PIPE, run
+from typing import Final
+
+lock_name: Final = "subprojects.lock"
+_commit_re: Final = re.compile(r"[0-9a-f]{40}")
+
+
+@dataclass
+class Lock:
+    url: str
+    ref: str
+    commit: str
+    # The contents of “subprojects.txt” (if it exists) and their dependency closure
+    selection: list[str] | None
+    resolved: list[str]
+    # The SHA-256 of each vendored file, relative to “subprojects”
+    files: dict[str, str]
+
+
+def read_lock(project_path: Path) -> Lock | None:
+    path = project_path / lock_name
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return Lock(**json.load(f))
+
+
+def write_lock(project_path: Path, lock: Lock):
+    contents = json.dumps(asdict(lock), indent=2) + "\n"
+    path = project_path / lock_name
+    if not path.exists() or path.read_text() != contents:
+        path.write_text(contents)
+
+
+def file_hashes(root: Path) -> dict[str, str]:
+    return {
+        Path(dirpath, f)
+        .relative_to(root)
+        .as_posix(): sha256(Path(dirpath, f).read_bytes())
+        .hexdigest()
+        for dirpath, _, filenames in os.walk(root)
+        for f in filenames
+    }
+
+
+def is_intact(subprojects_path: Path, lock: Lock) -> bool:
+    """Check whether the vendored files are exactly those recorded in the lock."""
+    wraps = {p.name for p in subprojects_path.glob("*.wrap")}
+    if wraps != {f for f in lock.files if "/" not in f and f.endswith(".wrap")}:
+        return False
+    for rel, h in lock.files.items():
+        path = subprojects_path / rel
+        if not path.is_file() or sha256(path.read_bytes()).hexdigest() != h:
+            return False
+    return True
+
+
+def resolve_commit(url: str, ref: str) -> str | None:
+    """Determine the commit of the given ref with a single request, if possible."""
+    if _commit_re.fullmatch(ref):
+        return ref
+    res = run(["git", "ls-remote", url, ref], stdout=PIPE, text=True)
+    if res.returncode != 0:
+        return None
+    refs = [line.split("\t") for line in res.stdout.splitlines()]
+    # Annotated tags are listed twice, the second time peeled to their commit
+    peeled = [c for c, name in refs if name.endswith("^{}")]
+    return (peeled or [c for c, _ in refs] or [None])[0]
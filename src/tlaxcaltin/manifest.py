@@ -0,0 +1,90 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# A machine-readable summary of all wraps in Tlaxcaltin, which is stored in the
+# repository as “manifest.json” and allows determining the files required by a
+# selection of subprojects without checking out the whole repository.
+
+import json
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Final
+
+from .graph import DependencyGraph
+from .wraps import read_wraps
+
+manifest_name: Final = "manifest.json"
+# Files in the root folder that are always required
+root_files: Final = (".gitignore", "License", "LicenseWrapDB", "ReadMe.md")
+# Folders in the root folder that are not subprojects
+_non_subproject_folders: Final = {"packagefiles", "private", "src"}
+
+folder_names: Final = {
+    "boost-preprocessor": "preprocessor-boost",
+    "combblas": "CombBLAS",
+    "google-benchmark": "benchmark",
+    "gtest": "googletest",
+    "liblzma": "xz",
+    "nlohmann-json": "nlohmann_json",
+    "sdl2": "SDL2",
+    "suitesparse": "SuiteSparse",
+    "xmp-toolkit-sdk": "XMP-Toolkit-SDK",
+}
+wrapdb_names: Final = {"fmt", "google-benchmark", "liblzma", "nlohmann-json"}
+
+Manifest = dict[str, Any]
+
+
+def build_manifest(base_path: Path) -> Manifest:
+    folders = sorted(
+        p.name
+        for p in base_path.iterdir()
+        if p.is_dir()
+        and p.name not in _non_subproject_folders
+        and (p / "meson.build").exists()
+    )
+    wraps: dict[str, Any] = {}
+    for name, wrap in read_wraps(base_path).items():
+        entry = asdict(wrap)
+        del entry["name"]
+        entry["folder_name"] = folder_names.get(name, name)
+        entry["wrapdb"] = name in wrapdb_names
+        wraps[name] = entry
+    return {"folders": folders, "wraps": wraps}
+
+
+def write_manifest(base_path: Path):
+    with open(base_path / manifest_name, "w") as f:
+        json.dump(build_manifest(base_path), f, indent=2)
+        f.write("\n")
+
+
+def read_manifest(path: Path) -> Manifest:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_graph(path: Path) -> DependencyGraph:
+    """Load the dependency graph from the manifest in the given folder or its wraps."""
+    if (manifest_path := path / manifest_name).exists():
+        return DependencyGraph.from_manifest(read_manifest(manifest_path))
+    return DependencyGraph.from_path(path)
+
+
+def sparse_patterns(manifest: Manifest, selection: set[str]) -> list[str]:
+    """Non-cone sparse-checkout patterns for all files the selection requires."""
+    patterns = [f"/{f}" for f in (manifest_name, *root_files)]
+    graph = DependencyGraph.from_manifest(manifest)
+    for name in sorted(graph.closure(selection, strict=False)):
+        if name in manifest["folders"]:
+            patterns.append(f"/{name}/")
+        if (wrap := manifest["wraps"].get(name)) is None:
+            continue
+        patterns.append(f"/{name}.wrap")
+        if wrap["patch_directory"] is not None:
+            patterns.append(f"/packagefiles/{wrap['patch_directory']}/")
+        patterns += [f"/packagefiles/{d}" for d in wrap["diff_files"]]
+    return patterns
@@ -0,0 +1,80 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# A persistent mirror of the Tlaxcaltin repository in the user’s cache folder,
+# which is refreshed using incremental fetches and can be used offline.
+
+import os
+import re
+from collections.abc import Iterator
+from contextlib import contextmanager
+from hashlib import sha256
+from pathlib import Path
+from shutil import rmtree
+from subprocess import PIPE, run
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def cache_path() -> Path:
+    if (path := os.environ.get("TLAXCALTIN_CACHE")) is not None:
+        return Path(path)
+    xdg_cache = os.environ.get("XDG_CACHE_HOME")
+    return (Path(xdg_cache) if xdg_cache else Path.home() / ".cache") / "tlaxcaltin"
+
+
+def mirror_path(url: str) -> Path:
+    name = re.sub(r"[^\w.-]+", "_", url.rstrip("/").rsplit("/", 1)[-1])
+    return cache_path() / "mirrors" / f"{name}-{sha256(url.encode()).hexdigest()[:12]}"
+
+
+@contextmanager
+def _locked(path: Path) -> Iterator[None]:
+    """Serialize accesses to the given mirror between processes."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(f"{path.name}.lock"), "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def update_mirror(url: str, offline: bool = False) -> Path:
+    """Create or refresh the mirror of the given repository and return its path."""
+    path = mirror_path(url)
+    with _locked(path):
+        if offline:
+            if not path.exists():
+                raise FileNotFoundError(f"No mirror of {url} exists at {path}")
+            return path
+
+        if path.exists():
+            run(["git", "-C", path, "remote", "update", "--prune"], check=True)
+            return path
+
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        rmtree(tmp_path, ignore_errors=True)
+        run(["git", "clone", "--mirror", url, tmp_path], check=True)
+        # Allow partial and shallow clones of arbitrary commits from the mirror
+        for key in ("uploadpack.allowFilter", "uploadpack.allowAnySHA1InWant"):
+            run(["git", "-C", tmp_path, "config", key, "true"], check=True)
+        tmp_path.rename(path)
+        return path
+
+
+def mirror_commit(url: str, ref: str) -> str | None:
+    """Look up the commit of the given ref in the mirror without refreshing it."""
+    path = mirror_path(url)
+    if not path.exists():
+        return None
+    res = run(
+        ["git", "-C", path, "rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}"],
+        stdout=PIPE,
+        text=True,
+    )
+    return res.stdout.strip() if res.returncode == 0 else None
@@ -0,0 +1,307 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# A report of the build time of each subproject and target of an existing Meson
+# build folder, which combines the commands of the last build recorded in Ninja’s
+# “.ninja_log” with Meson’s introspection files to attribute each command to the
+# target and subproject that it belongs to.
+#
+# Ninja only records the wall time of each command, so the CPU time is the sum of
+# these durations, and the critical path is approximated by starting with the last
+# command and repeatedly going to the command that finished last before the
+# current one started. Meson does not record how long configuring each subproject
+# takes, which is why the lines of its build files are reported instead, while
+# the time taken by regenerating the build files is listed as “(meson)”.
+
+import json
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Final
+
+from .artifacts import read_intro
+from .wraps import read_wraps
+
+_main_name: Final = "(main)"
+_meson_name: Final = "(meson)"
+_meson_outputs: Final = {"build.ninja", "meson-private/coredata.dat"}
+_object_suffixes: Final = (".o", ".obj")
+_build_file_names: Final = {"meson.build", "meson_options.txt", "meson.options"}
+
+
+@dataclass(frozen=True)
+class BuildCommand:
+    # Milliseconds since the start of the build
+    start: int
+    end: int
+    outputs: tuple[str, ...]
+
+    @property
+    def duration(self) -> int:
+        return self.end - self.start
+
+
+def read_ninja_log(build_path: Path) -> list[BuildCommand]:
+    """
+    The commands of the last build in the Ninja log, where a build starts whenever
+    a command finishes before the previous one or an output is built again, with
+    one entry for all outputs of a command.
+    """
+    path = build_path / ".ninja_log"
+    if not path.exists():
+        raise ValueError(f"{path} does not exist, build the project first")
+    with open(path, "r") as f:
+        lines = f.read().splitlines()
+    if not lines or not lines[0].startswith("# ninja log v"):
+        raise ValueError(f"{path} is not a Ninja log")
+
+    builds: list[list[list[str]]] = [[]]
+    seen: set[str] = set()
+    last_end = 0
+    for line in lines[1:]:
+        fields = line.split("\t")
+        if len(fields) < 5:
+            continue
+        if int(fields[1]) < last_end or fields[3] in seen:
+            builds.append([])
+            seen.clear()
+        last_end = int(fields[1])
+        seen.add(fields[3])
+        builds[-1].append(fields)
+
+    # Commands with several outputs have one entry per output
+    outputs: dict[tuple[int, int, str], list[str]] = {}
+    for start, end, _, output, command_hash in builds[-1]:
+        outputs.setdefault((int(start), int(end), command_hash), []).append(output)
+    return sorted(
+        (BuildCommand(start, end, tuple(o)) for (start, end, _), o in outputs.items()),
+        key=lambda c: (c.start, c.end),
+    )
+
+
+def _wall_time(commands: list[BuildCommand]) -> int:
+    """The time during which any of the commands was running."""
+    total, end = 0, 0
+    for c in sorted(commands, key=lambda c: c.start):
+        if c.end > end:
+            total += c.end - max(c.start, end)
+            end = c.end
+    return total
+
+
+@dataclass
+class Usage:
+    commands: list[BuildCommand] = field(default_factory=list)
+    objects: int = 0
+
+    def add(self, command: BuildCommand):
+        self.commands.append(command)
+        self.objects += sum(o.endswith(_object_suffixes) for o in command.outputs)
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "wall": _wall_time(self.commands) / 1000,
+            "cpu": sum(c.duration for c in self.commands) / 1000,
+            "objects": self.objects,
+            "commands": len(self.commands),
+        }
+
+
+class BuildProfile:
+    def __init__(self, build_path: Path):
+        self.build_path = build_path.resolve()
+        self.commands = read_ninja_log(build_path)
+        info = read_intro(build_path, "projectinfo")
+        self.subproject_dir: str = info.get("subproject_dir", "subprojects")
+        self.source_path = self._source_path()
+
+        # The folders of the subprojects in the source and the build folder
+        wraps = read_wraps(self.source_path / self.subproject_dir)
+        self.folders = {w.directory: name for name, w in wraps.items()}
+        for sp in info.get("subprojects", []):
+            self.folders.setdefault(sp["name"], sp["name"])
+
+        # Outputs of targets and the folders of their intermediate files
+        self.targets: dict[str, tuple[str, str]] = {}
+        self.target_count: dict[str, int] = {}
+        for t in read_intro(build_path, "targets"):
+            subproject = t.get("subproject") or _main_name
+            self.target_count[subproject] = self.target_count.get(subproject, 0) + 1
+            for filename in t.get("filename", []):
+                rel = self._relative(Path(filename), self.build_path)
+                if rel is not None:
+                    self.targets[rel] = (subproject, t["name"])
+
+    def _source_path(self) -> Path:
+        path = self.build_path / "meson-info" / "meson-info.json"
+        if path.exists():
+            with open(path, "r") as f:
+                return Path(json.load(f)["directories"]["source"])
+        return self.build_path.parent
+
+    @staticmethod
+    def _relative(path: Path, base: Path) -> str | None:
+        try:
+            return path.resolve().relative_to(base).as_posix()
+        except ValueError:
+            return None
+
+    def _folder_owner(self, rel: str) -> str:
+        """The subproject owning a path relative to the source or build folder."""
+        parts = rel.split("/")
+        if len(parts) > 2 and parts[0] == self.subproject_dir:
+            return self.folders.get(parts[1], parts[1])
+        return _main_name
+
+    def owner(self, command: BuildCommand) -> tuple[str, str | None]:
+        """The subproject and target (if known) which a command belongs to."""
+        output = command.outputs[0]
+        if output in _meson_outputs:
+            return _meson_name, None
+        if (target := self.targets.get(output)) is not None:
+            return target
+        # Intermediate files are placed in “<target output>.p”
+        if ".p/" in output:
+            if (target := self.targets.get(output.split(".p/", 1)[0])) is not None:
+                return target
+        return self._folder_owner(output), None
+
+    def build_file_lines(self) -> dict[str, int]:
+        """The number of lines of the build files of each subproject."""
+        lines: dict[str, int] = {}
+        try:
+            files = read_intro(self.build_path, "buildsystem_files")
+        except ValueError:
+            return lines
+        for filename in files:
+            path = Path(filename)
+            rel = self._relative(path, self.source_path.resolve())
+            if path.name not in _build_file_names or rel is None or not path.exists():
+                continue
+            owner = self._folder_owner(rel)
+            with open(path, "rb") as f:
+                lines[owner] = lines.get(owner, 0) + sum(1 for _ in f)
+        return lines
+
+    def critical_path(self) -> list[BuildCommand]:
+        """Approximate the critical path by going back from the last command."""
+        if not self.commands:
+            return []
+        by_end = sorted(self.commands, key=lambda c: c.end)
+        ends = [c.end for c in by_end]
+        path = [by_end[-1]]
+        while (i := bisect_right(ends, path[-1].start)) > 0:
+            path.append(by_end[i - 1])
+        path.reverse()
+        return path
+
+    def report(self) -> dict[str, Any]:
+        subprojects: dict[str, Usage] = {}
+        targets: dict[tuple[str, str], Usage] = {}
+        owners: dict[BuildCommand, tuple[str, str | None]] = {}
+        for command in self.commands:
+            subproject, target = owners[command] = self.owner(command)
+            subprojects.setdefault(subproject, Usage()).add(command)
+            if target is not None:
+                targets.setdefault((subproject, target), Usage()).add(command)
+
+        lines = self.build_file_lines()
+        subproject_summaries = [
+            {
+                "name": name,
+                **usage.summary(),
+                "targets": self.target_count.get(name, 0),
+                "build_file_lines": lines.get(name, 0),
+            }
+            for name, usage in subprojects.items()
+        ]
+        target_summaries = [
+            {"subproject": subproject, "name": name, **usage.summary()}
+            for (subproject, name), usage in targets.items()
+        ]
+
+        path = self.critical_path()
+        contributions: dict[str, float] = {}
+        for c in path:
+            subproject = owners[c][0]
+            contributions[subproject] = contributions.get(subproject, 0) + c.duration
+        return {
+            "build_path": str(self.build_path),
+            "wall": _wall_time(self.commands) / 1000,
+            "cpu": sum(c.duration for c in self.commands) / 1000,
+            "commands": len(self.commands),
+            "subprojects": sorted(subproject_summaries, key=lambda s: -s["cpu"]),
+            "targets": sorted(target_summaries, key=lambda s: -s["cpu"]),
+            "critical_path": {
+                "duration": (path[-1].end - path[0].start) / 1000 if path else 0.0,
+                "subprojects": {
+                    k: v / 1000
+                    for k, v in sorted(contributions.items(), key=lambda kv: -kv[1])
+                },
+                "steps": [
+                    {
+                        "output": c.outputs[0],
+                        "subproject": owners[c][0],
+                        "target": owners[c][1],
+                        "start": c.start / 1000,
+                        "duration": c.duration / 1000,
+                    }
+                    for c in path
+                ],
+            },
+        }
+
+
+def _print_report(report: dict[str, Any], top: int):
+    print(
+        f"Last build: {report['commands']} commands, {report['wall']:.1f} s wall time, "
+        + f"{report['cpu']:.1f} s CPU time"
+    )
+    print()
+    width = max([len("Subproject")] + [len(s["name"]) for s in report["subprojects"]])
+    print(
+        f"{'Subproject':<{width}}  {'Wall [s]':>9}  {'CPU [s]':>9}  {'Objects':>7}  "
+        + f"{'Targets':>7}  {'Build lines':>11}"
+    )
+    for s in report["subprojects"]:
+        print(
+            f"{s['name']:<{width}}  {s['wall']:9.1f}  {s['cpu']:9.1f}  "
+            + f"{s['objects']:7}  {s['targets']:7}  {s['build_file_lines']:11}"
+        )
+
+    targets = report["targets"][:top]
+    if targets:
+        print()
+        names = [f"{t['subproject']}:{t['name']}" for t in targets]
+        width = max(len("Target"), *map(len, names))
+        print(f"{'Target':<{width}}  {'Wall [s]':>9}  {'CPU [s]':>9}  {'Objects':>7}")
+        for name, t in zip(names, targets):
+            print(
+                f"{name:<{width}}  {t['wall']:9.1f}  {t['cpu']:9.1f}  {t['objects']:7}"
+            )
+
+    critical = report["critical_path"]
+    print()
+    print(
+        f"Critical path: {critical['duration']:.1f} s "
+        + f"over {len(critical['steps'])} commands"
+    )
+    for name, duration in critical["subprojects"].items():
+        share = duration / critical["duration"] * 100 if critical["duration"] else 0
+        print(f"  {name}: {duration:.1f} s ({share:.0f} %)")
+    steps = sorted(critical["steps"], key=lambda s: -s["duration"])[:top]
+    if steps:
+        print("Longest commands on the critical path:")
+        for s in steps:
+            print(f"  {s['duration']:7.1f} s  {s['subproject']}  {s['output']}")
+
+
+def profile(build_path: Path, top: int, as_json: bool):
+    report = BuildProfile(build_path).report()
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report, top)
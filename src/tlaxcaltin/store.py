@@ -0,0 +1,190 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# A store of source archives shared between all projects of a user (or machine),
+# which is keyed by the “source_hash” of the wraps and from which the package
+# caches of the projects are populated using links instead of copies.
+
+import os
+import re
+from collections.abc import Iterable
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+from shutil import copy2, rmtree
+from typing import Final
+
+from .mirror import cache_path
+from .wraps import Wrap
+
+_chunk_size: Final = 1 << 20
+# The ioctl that creates a reflink on Linux
+_ficlone: Final = 0x40049409
+_size_re: Final = re.compile(r"(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?", re.IGNORECASE)
+
+
+def parse_size(size: str) -> int:
+    if (m := _size_re.fullmatch(size.strip())) is None:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(m.group(1)) * 1024 ** " KMGT".index(m.group(2).upper() or " "))
+
+
+def _reflink(src: Path, dst: Path):
+    from fcntl import ioctl
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            ioctl(d.fileno(), _ficlone, s.fileno())
+        except OSError:
+            dst.unlink()
+            raise
+
+
+def link_file(
+    src: Path,
+    dst: Path,
+    methods: Iterable[str] = ("reflink", "symlink", "copy"),
+) -> str:
+    """
+    Make “dst” refer to the contents of “src” using the first of the given
+    methods that succeeds, which are “hardlink”, “reflink”, “symlink”, and
+    “copy”. Hard links are not used by default, since removing a file from
+    the store does not free its space while it is linked elsewhere.
+    """
+    dst.unlink(missing_ok=True)
+    for method in methods:
+        try:
+            match method:
+                case "hardlink":
+                    os.link(src, dst)
+                case "reflink":
+                    _reflink(src, dst)
+                case "symlink":
+                    dst.symlink_to(src.resolve())
+                case "copy":
+                    copy2(src, dst)
+                case _:
+                    raise ValueError(f"Unknown link method: {method}")
+            return method
+        except (ImportError, OSError):
+            pass
+    raise OSError(f"Failed to link {src} to {dst}")
+
+
+def file_hash(path: Path) -> str:
+    h = sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(_chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@dataclass(frozen=True)
+class StoreEntry:
+    path: Path
+    source_hash: str
+    size: int
+    last_use: float
+
+
+class Store:
+    def __init__(self, path: Path | None = None):
+        if path is None:
+            env_path = os.environ.get("TLAXCALTIN_STORE")
+            path = Path(env_path) if env_path else cache_path() / "store"
+        self.path = path
+
+    def entry_path(self, source_hash: str, filename: str) -> Path:
+        return self.path / source_hash / filename
+
+    def get(self, source_hash: str, filename: str) -> Path | None:
+        """Return the stored archive if it exists and mark it as recently used."""
+        path = self.entry_path(source_hash, filename)
+        if not path.is_file():
+            return None
+        os.utime(path)
+        return path
+
+    def add(self, path: Path, source_hash: str) -> Path | None:
+        """
+        Add the given archive to the store if its hash matches, which uses a
+        reflink if possible, and return the stored path.
+        """
+        entry_path = self.entry_path(source_hash, path.name)
+        if entry_path.is_file():
+            return entry_path
+        if file_hash(path) != source_hash:
+            return None
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = entry_path.with_name(f"{entry_path.name}.tmp")
+        link_file(path, tmp_path, ("reflink", "copy"))
+        tmp_path.replace(entry_path)
+        return entry_path
+
+    def entries(self) -> list[StoreEntry]:
+        if not self.path.is_dir():
+            return []
+        entries: list[StoreEntry] = []
+        for folder in self.path.iterdir():
+            for p in folder.iterdir() if folder.is_dir() else ():
+                if p.suffix in (".part", ".tmp"):
+                    continue
+                stat = p.stat()
+                entries.append(StoreEntry(p, folder.name, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e.last_use)
+
+    def prune(self, max_size: int) -> list[StoreEntry]:
+        """Remove the least recently used archives until the store fits the size."""
+        entries = self.entries()
+        size = sum(e.size for e in entries)
+        removed: list[StoreEntry] = []
+        for entry in entries:
+            if size <= max_size:
+                break
+            rmtree(entry.path.parent)
+            size -= entry.size
+            removed.append(entry)
+        return removed
+
+    def populate(self, package_cache_path: Path, wraps: Iterable[Wrap]) -> int:
+        """
+        Link the archives of the given wraps from the store into the package cache
+        and add archives which are only present in the package cache to the store.
+        Links whose archive has been pruned from the store are removed, so that the
+        archive counts as missing.
+        Returns the number of archives linked into the package cache.
+        """
+        linked = 0
+        for wrap in wraps:
+            if wrap.source_hash is None or wrap.source_filename is None:
+                continue
+            dst = package_cache_path / wrap.source_filename
+            if dst.is_symlink() and not dst.exists():
+                dst.unlink()
+                print(
+                    f"Removed the link to {dst.name}, which was pruned from the store"
+                )
+            if dst.exists():
+                if not dst.is_symlink():
+                    self.add(dst, wrap.source_hash)
+                continue
+            if (src := self.get(wrap.source_hash, wrap.source_filename)) is not None:
+                package_cache_path.mkdir(parents=True, exist_ok=True)
+                link_file(src, dst)
+                linked += 1
+        return linked
+
+
+def show_cache(prune: str | None):
+    store = Store()
+    if prune is not None:
+        for entry in store.prune(parse_size(prune)):
+            print(f"Removed {entry.path.name} ({entry.size / 2**20:.1f} MiB)")
+    entries = store.entries()
+    for entry in reversed(entries):
+        print(f"{entry.path.name}  {entry.size / 2**20:.1f} MiB  {entry.source_hash}")
+    total = sum(e.size for e in entries)
+    print(f"{len(entries)} archives, {total / 2**30:.2f} GiB in {store.path}")
@@ -0,0 +1,152 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Lightweight instrumentation of the phases of Tlaxcaltin’s commands and scripts,
+# which records the wall time of nested spans together with counts such as the
+# number of files or bytes written. The spans can be printed as JSON or written as
+# a Chrome trace, which can be viewed using “chrome://tracing” or Perfetto.
+
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any, Final
+
+
+@dataclass
+class Span:
+    name: str
+    # Seconds since the creation of the tracer
+    start: float
+    thread: int
+    depth: int
+    duration: float = 0.0
+    counts: dict[str, int] = field(default_factory=dict)
+
+    def count(self, **counts: int):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+
+class Tracer:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+        # The stack of open spans of each thread
+        self._local = threading.local()
+
+    def _stack(self) -> list[Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        stack = self._stack()
+        span = Span(
+            name,
+            time.perf_counter() - self.origin,
+            threading.get_ident(),
+            len(stack),
+        )
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - self.origin - span.start
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def count(self, **counts: int):
+        """Add to the counts of the innermost open span of this thread, if any."""
+        if stack := self._stack():
+            stack[-1].count(**counts)
+
+    def export(self, first: int = 0) -> list[Span]:
+        """
+        The spans after the given number of spans, starting at “time.perf_counter”
+        times and assigned to this process, to be merged into another process.
+        """
+        pid = os.getpid()
+        with self._lock:
+            spans = self.spans[first:]
+        # Forked processes inherit the open spans of their parent
+        depth = min((s.depth for s in spans), default=0)
+        return [
+            replace(s, start=s.start + self.origin, thread=pid, depth=s.depth - depth)
+            for s in spans
+        ]
+
+    def merge(self, spans: list[Span]):
+        """Add exported spans, nested in the innermost open span of this thread."""
+        depth = len(self._stack())
+        with self._lock:
+            self.spans += [
+                replace(s, start=s.start - self.origin, depth=s.depth + depth)
+                for s in spans
+            ]
+
+    def summary(self) -> list[dict[str, Any]]:
+        """The spans in the order in which they have been started."""
+        return [
+            {
+                "name": s.name,
+                "depth": s.depth,
+                "start": round(s.start, 6),
+                "duration": round(s.duration, 6),
+                **s.counts,
+            }
+            for s in sorted(self.spans, key=lambda s: s.start)
+        ]
+
+    def chrome_trace(self) -> dict[str, Any]:
+        pid = os.getpid()
+        events = [
+            {
+                "name": s.name,
+                "ph": "X",
+                "ts": s.start * 1e6,
+                "dur": s.duration * 1e6,
+                "pid": pid,
+                "tid": s.thread,
+                "args": s.counts,
+            }
+            for s in self.spans
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path: Path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+# The tracer of this process, which is used by all instrumented code
+tracer: Final = Tracer()
+
+
+def span(name: str):
+    return tracer.span(name)
+
+
+def count(**counts: int):
+    tracer.count(**counts)
+
+
+def report(timings: bool):
+    """
+    Print the spans as JSON if requested and write the Chrome trace to the path
+    given by “TLAXCALTIN_TRACE” if it is set.
+    """
+    if timings:
+        print(json.dumps(tracer.summary(), indent=2))
+    if trace_path := os.environ.get("TLAXCALTIN_TRACE"):
+        tracer.write_chrome_trace(Path(trace_path))
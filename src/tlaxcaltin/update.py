@@ -8,151 +8,474 @@
 # in this file. Note that this requires “subprojects.txt” to exist in the root folder
 # of the project using Tlaxcaltin.
 
+import os
 import re
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from io import StringIO
 from pathlib import Path
-from shutil import move, rmtree
-from subprocess import run
+from shutil import copy2, copytree, rmtree
+from subprocess import PIPE, STDOUT, run
 from tempfile import TemporaryDirectory
 from typing import Final
 
+from .graph import DependencyGraph
+from .manifest import (
+    folder_names,
+    manifest_name,
+    read_manifest,
+    sparse_patterns,
+    wrapdb_names,
+)
+from .lock import (
+    Lock,
+    file_hashes,
+    is_intact,
+    lock_name,
+    read_lock,
+    resolve_commit,
+    write_lock,
+)
+from .mirror import mirror_commit, update_mirror
+from .store import Store
+from .trace import Span, count, span, tracer
+from .wraps import read_wraps, wrap_digest
+
 _tlax_url: Final = "https://github.com/KurtBoehm/tlaxcaltin.git"
-_folder_names: Final = {
-    "boost-preprocessor": "preprocessor-boost",
-    "combblas": "CombBLAS",
-    "google-benchmark": "benchmark",
-    "gtest": "googletest",
-    "liblzma": "xz",
-    "nlohmann-json": "nlohmann_json",
-    "sdl2": "SDL2",
-    "suitesparse": "SuiteSparse",
-    "xmp-toolkit-sdk": "XMP-Toolkit-SDK",
-}
-_wrapdb_names: Final = {"fmt", "google-benchmark", "liblzma", "nlohmann-json"}
-
-
-def _expand_selection(subprojects_path: Path, selection: set[str]) -> set[str]:
-    new_selection: set[str] = set()
-    for s in selection:
-        new_selection.add(s)
-        wrap_path = subprojects_path / f"{s}.wrap"
-        if not wrap_path.exists():
-            continue
-        with open(wrap_path, "r") as f:
-            txt = f.read()
-        dependencies_lines = [
-            line for line in txt.splitlines() if line.startswith("# dependencies: ")
-        ]
-        if len(dependencies_lines) == 0:
-            continue
-        dependencies = [
-            d.strip() for line in dependencies_lines for d in line[16:].split(",")
-        ]
-        new_selection = new_selection.union(dependencies)
-    if new_selection != selection:
-        new_selection = _expand_selection(subprojects_path, new_selection)
-        print(f"expanded selection: {new_selection}")
-    return new_selection
-
-
-def update(project_path: Path, add: bool):
-    subprojects_path: Final = project_path / "subprojects"
-    selection_path: Final = project_path / "subprojects.txt"
 
-    selection: set[str] | None
+
+def read_selection(project_path: Path) -> set[str] | None:
+    selection_path = project_path / "subprojects.txt"
     if not selection_path.exists():
-        print("No subprojects file exists.")
-        selection = None
-    else:
-        with open(selection_path, "r") as f:
-            selection = {line.strip() for line in f.readlines()}
+        return None
+    with open(selection_path, "r") as f:
+        return {line.strip() for line in f.readlines() if line.strip()}
 
-    with TemporaryDirectory() as tmp_dir:
-        tmp_path = Path(tmp_dir).resolve()
 
-        package_cache_path = subprojects_path / "packagecache"
-        packagecache_tmp_path = tmp_path / "packagecache"
-
-        has_packagecache = package_cache_path.exists()
-        if has_packagecache:
-            move(package_cache_path, packagecache_tmp_path)
-
-        rmtree(subprojects_path)
-        run(["git", "clone", _tlax_url, "subprojects"], check=True)
-        rmtree(subprojects_path / ".git")
-        rmtree(subprojects_path / "private")
-        (subprojects_path / "pyproject.toml").unlink()
-
-        # Remove all subprojects that are not desired
-        if selection is not None:
-            selection = _expand_selection(subprojects_path, selection)
-            wrapdb_deps = _wrapdb_names & selection
-            fnames = {_folder_names.get(entry, entry) for entry in selection}
-
-            # Create read-me
-            readme_path = subprojects_path / "ReadMe.md"
-            with open(readme_path, "r") as f:
-                readme = f.read()
-            readme = readme[readme.find("## Licence\n") + 12 :]
-            readme = readme.replace(
-                "Tlaxcaltin",
-                "[Tlaxcaltin](https://github.com/KurtBoehm/tlaxcaltin)",
-            )
-            readme = readme.splitlines()[: (4 if len(wrapdb_deps) > 0 else 1)]
-            readme += [f"- `{wdb}`" for wdb in sorted(wrapdb_deps)]
-            readme = "\n".join(readme) + "\n"
-            with open(readme_path, "w") as f:
-                f.write(readme)
-
-            # Remove the WrapDB licence if none of those dependencies are used
-            if len(wrapdb_deps) == 0:
-                (subprojects_path / "LicenseWrapDB").unlink()
-
-            # Remove wraps and direct subfolders
-            for p in subprojects_path.iterdir():
-                if p.is_file() and p.suffix == ".wrap":
-                    if p.stem not in selection:
-                        p.unlink()
-                        continue
-                if p.is_dir() and p.name not in fnames | {"packagefiles"}:
-                    rmtree(p)
-
-            # Remove package files
-            package_files_path = subprojects_path / "packagefiles"
+def _prune(subprojects_path: Path, selection: set[str]) -> list[str]:
+    """
+    Remove everything from a fresh checkout that the selection does not need
+    and return the expanded selection in topological order.
+    """
+    with span("expand selection"):
+        graph = DependencyGraph.from_path(subprojects_path)
+        if unknown := graph.unknown(selection):
+            print(f"Unknown subprojects: {', '.join(unknown)}")
+        resolved = graph.resolve(selection, strict=False)
+    selection = set(resolved)
+    print(f"Expanded selection: {', '.join(sorted(selection))}")
+    wrapdb_deps = wrapdb_names & selection
+    fnames = {folder_names.get(entry, entry) for entry in selection}
+
+    # Create read-me
+    with span("rewrite ReadMe"):
+        readme_path = subprojects_path / "ReadMe.md"
+        with open(readme_path, "r") as f:
+            readme = f.read()
+        readme = readme[readme.find("## Licence\n") + 12 :]
+        readme = readme.replace(
+            "Tlaxcaltin",
+            "[Tlaxcaltin](https://github.com/KurtBoehm/tlaxcaltin)",
+        )
+        readme = readme.splitlines()[: (4 if len(wrapdb_deps) > 0 else 1)]
+        readme += [f"- `{wdb}`" for wdb in sorted(wrapdb_deps)]
+        readme = "\n".join(readme) + "\n"
+        with open(readme_path, "w") as f:
+            f.write(readme)
+
+    # Remove the WrapDB licence if none of those dependencies are used
+    if len(wrapdb_deps) == 0:
+        (subprojects_path / "LicenseWrapDB").unlink()
+
+    # Remove wraps and direct subfolders
+    with span("remove subprojects"):
+        for p in subprojects_path.iterdir():
+            if p.is_file() and p.suffix == ".wrap":
+                if p.stem not in selection:
+                    _remove(p)
+                    continue
+            if p.is_dir() and p.name not in fnames | {"packagefiles"}:
+                _remove(p)
+
+        # Remove package files
+        package_files_path = subprojects_path / "packagefiles"
+        if package_files_path.exists():
             for p in package_files_path.iterdir():
                 if p.name not in selection | {"patch"}:
-                    rmtree(p)
+                    _remove(p)
             if len(list(package_files_path.iterdir())) == 0:
                 package_files_path.rmdir()
 
-            # Remove patches
-            patch_path = package_files_path / "patch"
-            if patch_path.exists():
-                for p in patch_path.iterdir():
-                    if p.stem not in selection:
-                        p.unlink()
-                if len(list(patch_path.iterdir())) == 0:
-                    patch_path.rmdir()
-
-            # Clean up gitignore
-            gitignore_path = subprojects_path / ".gitignore"
-            with open(gitignore_path, "r") as f:
-                gitignore = f.readlines()
-            new_gitignore = []
-            folder_re = re.compile(r"/(.*)-\*/")
-            for line in gitignore:
-                line = line.strip()
-                if (m := folder_re.fullmatch(line)) is not None:
-                    if m.group(1) in fnames:
-                        new_gitignore.append(line)
-                else:
+        # Remove patches
+        patch_path = package_files_path / "patch"
+        if patch_path.exists():
+            for p in patch_path.iterdir():
+                if p.stem not in selection:
+                    _remove(p)
+            if len(list(patch_path.iterdir())) == 0:
+                patch_path.rmdir()
+
+    # Clean up gitignore
+    with span("rewrite .gitignore"):
+        gitignore_path = subprojects_path / ".gitignore"
+        with open(gitignore_path, "r") as f:
+            gitignore = f.readlines()
+        new_gitignore = []
+        folder_re = re.compile(r"/(.*)-\*/")
+        for line in gitignore:
+            line = line.strip()
+            if (m := folder_re.fullmatch(line)) is not None:
+                if m.group(1) in fnames:
                     new_gitignore.append(line)
-            if new_gitignore[-1] == "":
-                new_gitignore.pop()
-            with open(gitignore_path, "w") as f:
-                f.write("".join(f"{line!s}\n" for line in new_gitignore))
+            else:
+                new_gitignore.append(line)
+        if new_gitignore[-1] == "":
+            new_gitignore.pop()
+        with open(gitignore_path, "w") as f:
+            f.write("".join(f"{line!s}\n" for line in new_gitignore))
+
+    return resolved
+
+
+def _same_file(a: Path, b: Path) -> bool:
+    if not b.is_file() or a.stat().st_size != b.stat().st_size:
+        return False
+    return a.read_bytes() == b.read_bytes()
+
+
+def _remove(p: Path):
+    if p.is_dir() and not p.is_symlink():
+        rmtree(p)
+    else:
+        p.unlink()
+    count(removed=1)
+
+
+def _sync_tree(src: Path, dst: Path, keep: Iterable[str] = ()):
+    """
+    Make “dst” identical to “src” (apart from the direct children in “keep”),
+    only touching files whose contents differ so that their modification times
+    (and thereby Meson’s build state) are preserved.
+    """
+    keep = set(keep)
+    dst.mkdir(exist_ok=True)
+    for p in dst.iterdir():
+        if p.name not in keep and not (src / p.name).exists():
+            _remove(p)
+    for p in src.iterdir():
+        outp = dst / p.name
+        if p.is_dir():
+            if outp.exists() and not outp.is_dir():
+                _remove(outp)
+            _sync_tree(p, outp)
+        elif not _same_file(p, outp):
+            if outp.is_dir():
+                rmtree(outp)
+            copy2(p, outp)
+            count(files=1, bytes=p.stat().st_size)
+
+
+def _fetch(url: str, ref: str, staging_path: Path, selection: set[str] | None) -> str:
+    """
+    Fetch the given revision into the staging path and return its commit.
+    If there is a selection,
+    the blobs are not fetched and only the manifest is checked out at first,
+    which is then used to determine the files required by the selection,
+    whose blobs are fetched lazily.
+    """
+    git = ["git", "-C", str(staging_path)]
+    run(["git", "init", "--quiet", staging_path], check=True)
+    fetch_args = ["--depth", "1"]
+    if selection is not None:
+        fetch_args.append("--filter=blob:none")
+        run(
+            [*git, "sparse-checkout", "set", "--no-cone", f"/{manifest_name}"],
+            check=True,
+        )
+    with span("git fetch"):
+        run([*git, "fetch", *fetch_args, url, ref], check=True)
+    with span("git checkout"):
+        run([*git, "checkout", "--quiet", "FETCH_HEAD"], check=True)
+    commit = run(
+        [*git, "rev-parse", "HEAD"], check=True, stdout=PIPE, text=True
+    ).stdout.strip()
+    if selection is None:
+        return commit
+
+    manifest_path = staging_path / manifest_name
+    if not manifest_path.exists():
+        print("No manifest exists, checking out everything.")
+        run([*git, "sparse-checkout", "disable"], check=True)
+        return commit
+    patterns = sparse_patterns(read_manifest(manifest_path), selection)
+    with span("git sparse-checkout"):
+        run([*git, "sparse-checkout", "set", "--no-cone", *patterns], check=True)
+    return commit
+
+
+def _resolve_commit(url: str, ref: str, offline: bool) -> str | None:
+    with span("resolve commit"):
+        if offline:
+            return mirror_commit(url, ref)
+        return resolve_commit(url, ref)
+
+
+def _intact_lock(project_path: Path, selection: set[str] | None) -> Lock | None:
+    """The lock of the project if it matches the selection and the vendored files."""
+    with span("check lock"):
+        lock = read_lock(project_path)
+        sorted_selection = None if selection is None else sorted(selection)
+        if (
+            lock is not None
+            and lock.selection == sorted_selection
+            and is_intact(project_path / "subprojects", lock)
+        ):
+            return lock
+        return None
+
+
+def _checkout(
+    url: str,
+    ref: str,
+    staging_path: Path,
+    selection: set[str] | None,
+    mirror: bool,
+    offline: bool,
+) -> str:
+    """Check out the files of Tlaxcaltin in the staging path and return the commit."""
+    with span("update mirror"):
+        if mirror:
+            fetch_url = update_mirror(url, offline).as_uri()
+        elif offline:
+            raise ValueError("Offline updates require a mirror")
+        else:
+            fetch_url = url
+    with span("fetch"):
+        commit = _fetch(fetch_url, ref, staging_path, selection)
+    with span("clean checkout"):
+        rmtree(staging_path / ".git")
+        for folder in ("private", "src"):
+            rmtree(staging_path / folder, ignore_errors=True)
+        for file in ("pyproject.toml", manifest_name):
+            (staging_path / file).unlink(missing_ok=True)
+    return commit
+
+
+def _install(
+    project_path: Path,
+    staging_path: Path,
+    selection: set[str] | None,
+    url: str,
+    ref: str,
+    commit: str,
+    add: bool,
+):
+    """Prune the checkout in the staging path and vendor it into the project."""
+    subprojects_path: Final = project_path / "subprojects"
+
+    # Remove all subprojects that are not desired
+    resolved = sorted(p.stem for p in staging_path.glob("*.wrap"))
+    if selection is not None:
+        with span("prune"):
+            resolved = _prune(staging_path, selection)
+
+    # Keep the extracted sources of all subprojects whose wrap, patch directory
+    # and diff files are unchanged, as well as the package cache
+    with span("remove outdated sources"):
+        old_wraps = read_wraps(subprojects_path)
+        new_wraps = read_wraps(staging_path)
+        keep = {"packagecache"}
+        for name, old_wrap in old_wraps.items():
+            new_wrap = new_wraps.get(name)
+            old_src = subprojects_path / old_wrap.directory
+            if new_wrap is not None and wrap_digest(
+                subprojects_path, old_wrap
+            ) == wrap_digest(staging_path, new_wrap):
+                keep.add(old_wrap.directory)
+            elif old_src.exists():
+                print(f"Remove outdated sources {old_src}")
+                _remove(old_src)
+
+    # Synchronize everything else
+    with span("sync"):
+        _sync_tree(staging_path, subprojects_path, keep)
+    with span("write lock") as s:
+        files = file_hashes(staging_path)
+        s.count(files=len(files))
+        sorted_selection = None if selection is None else sorted(selection)
+        write_lock(
+            project_path,
+            Lock(url, ref, commit, sorted_selection, resolved, files),
+        )
+
+    # Link the archives that are present in the shared store into the package cache
+    with span("populate package cache") as s:
+        store = Store()
+        package_cache_path = subprojects_path / "packagecache"
+        linked = store.populate(package_cache_path, new_wraps.values())
+        s.count(files=linked)
+    if linked > 0:
+        print(f"Linked {linked} archives from {store.path}")
+
+    if add:
+        # Capture the output, which would bypass redirecting “sys.stdout” otherwise
+        with span("git add"):
+            res = run(
+                ["git", "add", "subprojects", lock_name],
+                cwd=project_path,
+                stdout=PIPE,
+                stderr=STDOUT,
+                text=True,
+            )
+            print(res.stdout, end="")
+            res.check_returncode()
+
+
+def update(
+    project_path: Path,
+    add: bool,
+    url: str | None = None,
+    ref: str | None = None,
+    sparse: bool = True,
+    mirror: bool = True,
+    offline: bool = False,
+    locked: bool = False,
+):
+    url = url or os.environ.get("TLAXCALTIN_URL")
+    ref = ref or os.environ.get("TLAXCALTIN_REF") or "HEAD"
+
+    selection = read_selection(project_path)
+    if selection is None:
+        print("No subprojects file exists.")
+
+    fetch_ref = ref
+    if locked:
+        if (lock := read_lock(project_path)) is None:
+            raise ValueError(f"{project_path / lock_name} does not exist")
+        # The locked commit is fetched from the locked URL unless another is given
+        url = url or lock.url
+        ref, fetch_ref = lock.ref, lock.commit
+    url = url or _tlax_url
+
+    # Return early if neither the selection, the vendored files, the URL, nor the
+    # commit to use have changed, which only requires looking up the remote commit
+    if (lock := _intact_lock(project_path, selection)) is not None and lock.url == url:
+        commit = _resolve_commit(url, fetch_ref, offline)
+        if commit == lock.commit:
+            print(f"Tlaxcaltin is up to date ({commit}).")
+            return
+
+    with TemporaryDirectory() as tmp_dir:
+        staging_path = Path(tmp_dir).resolve() / "subprojects"
+        commit = _checkout(
+            url,
+            fetch_ref,
+            staging_path,
+            selection if sparse else None,
+            mirror,
+            offline,
+        )
+        _install(project_path, staging_path, selection, url, ref, commit, add)
+
+
+def read_workspace(path: Path) -> list[Path]:
+    """
+    Read a workspace file, which lists one project path per line relative to the
+    folder containing it, ignoring empty lines and comments starting with “#”.
+    """
+    with open(path, "r") as f:
+        lines = [line.split("#", 1)[0].strip() for line in f.readlines()]
+    return [(path.parent / line).resolve() for line in lines if line]
+
+
+def _update_project(
+    project_path: Path,
+    checkout_path: Path,
+    url: str,
+    ref: str,
+    commit: str,
+    add: bool,
+) -> tuple[str, list[Span]]:
+    """
+    Vendor a copy of the shared checkout into a project and return the output and
+    the spans, which are merged into the tracer of the main process.
+    """
+    out = StringIO()
+    first = len(tracer.spans)
+    with redirect_stdout(out), TemporaryDirectory() as tmp_dir:
+        with span(project_path.name):
+            staging_path = Path(tmp_dir).resolve() / "subprojects"
+            copytree(checkout_path, staging_path, symlinks=True)
+            selection = read_selection(project_path)
+            _install(project_path, staging_path, selection, url, ref, commit, add)
+    return out.getvalue(), tracer.export(first)
+
+
+def update_many(
+    project_paths: list[Path],
+    add: bool,
+    url: str | None = None,
+    ref: str | None = None,
+    sparse: bool = True,
+    mirror: bool = True,
+    offline: bool = False,
+    jobs: int | None = None,
+):
+    """
+    Update several projects to the same commit, which is fetched only once
+    (restricted to the union of their selections) and then vendored into the
+    projects that are not up to date in parallel worker processes.
+    """
+    url = url or os.environ.get("TLAXCALTIN_URL") or _tlax_url
+    ref = ref or os.environ.get("TLAXCALTIN_REF") or "HEAD"
+
+    selections = {p: read_selection(p) for p in project_paths}
+    status: dict[Path, str] = {}
+    target = _resolve_commit(url, ref, offline)
+    for p, selection in selections.items():
+        lock = _intact_lock(p, selection)
+        if (
+            target is not None
+            and lock is not None
+            and (lock.url, lock.commit) == (url, target)
+        ):
+            status[p] = f"up to date ({target})"
+    pending = [p for p in project_paths if p not in status]
+
+    if pending:
+        union: set[str] | None = set()
+        for p in pending:
+            if not sparse or (selection := selections[p]) is None:
+                union = None
+                break
+            union |= selection
 
-        if add:
-            run(["git", "add", "subprojects"], check=True)
+        with TemporaryDirectory() as tmp_dir:
+            checkout_path = Path(tmp_dir).resolve() / "subprojects"
+            commit = _checkout(url, ref, checkout_path, union, mirror, offline)
+            with span("install"), ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {
+                    executor.submit(
+                        _update_project, p, checkout_path, url, ref, commit, add
+                    ): p
+                    for p in pending
+                }
+                for future in as_completed(futures):
+                    p = futures[future]
+                    try:
+                        output, spans = future.result()
+                        tracer.merge(spans)
+                        status[p] = f"updated to {commit}"
+                    except Exception as e:
+                        output = ""
+                        status[p] = f"FAILED ({type(e).__name__}: {e})"
+                    print(f"=== {p}: {status[p]}")
+                    print(output, end="")
 
-        if has_packagecache:
-            move(packagecache_tmp_path, package_cache_path)
+    print("Summary:")
+    width = max(len(str(p)) for p in project_paths)
+    for p in project_paths:
+        print(f"{str(p):<{width}}  {status[p]}")
+    if failures := sum(s.startswith("FAILED") for s in status.values()):
+        raise RuntimeError(f"{failures} of {len(project_paths)} updates failed")
@@ -0,0 +1,154 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Verify the source archives in the package cache of a project (and optionally in
+# the shared store) against the hashes in the wraps. Computed hashes are cached
+# keyed by the path, size, modification time, and inode of each file, so that
+# unchanged archives are never hashed again.
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Final
+
+from .deps import catalogue_path
+from .fetch import selected_file_wraps
+from .mirror import cache_path
+from .store import Store, file_hash
+from .wraps import read_wraps
+
+_hash_cache_name: Final = "hashes.json"
+
+
+class HashCache:
+    def __init__(self, path: Path | None = None):
+        self.path = path or cache_path() / _hash_cache_name
+        # Resolved path → [size, mtime_ns, inode, hash]
+        self.entries: dict[str, list[int | str]] = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r") as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                # Recreate a corrupted cache
+                self.entries = {}
+        self.changed = False
+
+    @staticmethod
+    def _stamp(st: os.stat_result) -> list[int | str]:
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def hash(self, path: Path) -> str:
+        """The SHA-256 of the file, which is only computed if it has changed."""
+        key = str(path.resolve())
+        st = os.stat(key)
+        stamp = self._stamp(st)
+        entry = self.entries.get(key)
+        if entry is not None and entry[:3] == stamp:
+            return str(entry[3])
+        h = file_hash(Path(key))
+        self.entries[key] = [*stamp, h]
+        self.changed = True
+        return h
+
+    def save(self):
+        """Write the cache atomically, dropping the entries of removed files."""
+        self.entries = {k: v for k, v in self.entries.items() if os.path.exists(k)}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        tmp_path.replace(self.path)
+
+
+@dataclass
+class Report:
+    ok: list[Path] = field(default_factory=list)
+    mismatched: list[Path] = field(default_factory=list)
+    missing: list[Path] = field(default_factory=list)
+    orphaned: list[Path] = field(default_factory=list)
+
+
+def _check(hashes: HashCache, expected: dict[Path, str], jobs: int, report: Report):
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        paths = list(expected)
+        for path, h in zip(paths, executor.map(hashes.hash, paths)):
+            (report.ok if h == expected[path] else report.mismatched).append(path)
+
+
+def verify_package_cache(
+    project_path: Path, hashes: HashCache, jobs: int, prune: bool
+) -> Report:
+    path = catalogue_path(project_path)
+    package_cache_path = path / "packagecache"
+    report = Report()
+
+    # Archives are required by the selected wraps, but only orphaned if no wrap
+    # refers to them at all
+    known = {w.source_filename for w in read_wraps(path).values()}
+    expected: dict[Path, str] = {}
+    for wrap in selected_file_wraps(project_path, []):
+        assert wrap.source_filename is not None
+        archive_path = package_cache_path / wrap.source_filename
+        if not archive_path.exists():
+            report.missing.append(archive_path)
+        elif wrap.source_hash is not None:
+            expected[archive_path] = wrap.source_hash
+    _check(hashes, expected, jobs, report)
+
+    if package_cache_path.is_dir():
+        for p in sorted(package_cache_path.iterdir()):
+            if p.is_file() and p.name not in known:
+                report.orphaned.append(p)
+                if prune:
+                    p.unlink()
+    return report
+
+
+def verify_store(store: Store, hashes: HashCache, jobs: int, prune: bool) -> Report:
+    """Verify that the archives in the store match the hashes they are stored under."""
+    report = Report()
+    expected = {e.path: e.source_hash for e in store.entries()}
+    _check(hashes, expected, jobs, report)
+    # Leftovers of interrupted downloads
+    if store.path.is_dir():
+        for p in sorted(store.path.glob("*/*")):
+            if p.suffix in (".part", ".tmp"):
+                report.orphaned.append(p)
+                if prune:
+                    p.unlink()
+    return report
+
+
+def _print_report(title: str, report: Report, prune: bool):
+    print(
+        f"{title}: {len(report.ok)} ok, {len(report.mismatched)} mismatched, "
+        + f"{len(report.missing)} missing, {len(report.orphaned)} orphaned"
+    )
+    for p in report.mismatched:
+        print(f"  mismatched: {p}")
+    for p in report.missing:
+        print(f"  missing: {p}")
+    for p in report.orphaned:
+        print(f"  {'removed' if prune else 'orphaned'}: {p}")
+
+
+def verify(project_path: Path, jobs: int, store: bool, prune: bool):
+    hashes = HashCache()
+    reports = [
+        ("Package cache", verify_package_cache(project_path, hashes, jobs, prune))
+    ]
+    if store:
+        reports.append(("Store", verify_store(Store(), hashes, jobs, prune)))
+    if hashes.changed or prune:
+        hashes.save()
+
+    for title, report in reports:
+        _print_report(title, report, prune)
+    if mismatched := sum(len(r.mismatched) for _, r in reports):
+        raise RuntimeError(f"{mismatched} archives do not match their hash")
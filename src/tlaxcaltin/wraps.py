@@ -0,0 +1,94 @@
+# This file is part of https://github.com/KurtBoehm/tlaxcaltin.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+# Lightweight parsing of the wrap files that make up Tlaxcaltin.
+
+from collections.abc import Iterable
+from configparser import ConfigParser
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+from typing import Final
+
+_dependencies_prefix: Final = "# dependencies: "
+
+
+@dataclass(frozen=True)
+class Wrap:
+    name: str
+    kind: str | None
+    # The folder into which Meson extracts/clones the sources
+    directory: str
+    patch_directory: str | None
+    # Paths relative to “packagefiles”
+    diff_files: tuple[str, ...]
+    dependencies: tuple[str, ...]
+    source_url: str | None = None
+    source_filename: str | None = None
+    source_hash: str | None = None
+
+
+def parse_dependencies(txt: str) -> tuple[str, ...]:
+    return tuple(
+        d.strip()
+        for line in txt.splitlines()
+        if line.startswith(_dependencies_prefix)
+        for d in line[len(_dependencies_prefix) :].split(",")
+        if d.strip()
+    )
+
+
+def parse_wrap(name: str, txt: str) -> Wrap:
+    parser = ConfigParser(interpolation=None)
+    parser.read_string(txt)
+    kind = next((s for s in parser.sections() if s.startswith("wrap-")), None)
+    body = parser[kind] if kind is not None else {}
+    diff_files = body.get("diff_files", "").strip()
+    return Wrap(
+        name=name,
+        kind=kind,
+        directory=body.get("directory", name),
+        patch_directory=body.get("patch_directory"),
+        diff_files=tuple(d.strip() for d in diff_files.split(",") if d.strip()),
+        dependencies=parse_dependencies(txt),
+        source_url=body.get("source_url"),
+        source_filename=body.get("source_filename"),
+        source_hash=body.get("source_hash"),
+    )
+
+
+def read_wrap(path: Path) -> Wrap:
+    with open(path, "r") as f:
+        return parse_wrap(path.stem, f.read())
+
+
+def read_wraps(path: Path) -> dict[str, Wrap]:
+    """Read all wraps in the given folder, indexed by their name."""
+    if not path.is_dir():
+        return {}
+    return {p.stem: read_wrap(p) for p in sorted(path.glob("*.wrap"))}
+
+
+def tree_digest(root: Path, rel_paths: Iterable[str]) -> str:
+    """Hash the names and contents of all files at or below the given paths."""
+    h = sha256()
+    for rel in sorted(rel_paths):
+        p = root / rel
+        files = sorted(f for f in p.rglob("*") if f.is_file()) if p.is_dir() else [p]
+        for f in files:
+            h.update(f"{f.relative_to(root).as_posix()}\0".encode())
+            h.update(f.read_bytes() if f.is_file() else b"<missing>")
+            h.update(b"\0")
+    return h.hexdigest()
+
+
+def wrap_digest(subprojects_path: Path, wrap: Wrap) -> str:
+    """Hash everything that Meson uses when extracting the subproject of a wrap."""
+    rel_paths = [f"{wrap.name}.wrap"]
+    if wrap.patch_directory is not None:
+        rel_paths.append(f"packagefiles/{wrap.patch_directory}")
+    rel_paths += [f"packagefiles/{d}" for d in wrap.diff_files]
+    return tree_digest(subprojects_path, rel_paths)